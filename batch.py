@@ -0,0 +1,175 @@
+"""Many boards stepped in lockstep with NumPy.
+
+BoardBatch holds K boards as one (K, height, width) uint8 array and mirrors
+the rules of engine.Board: drop_piece, full_drop_piece, move_piece,
+rotate_piece and finalize_piece act on every board at once, or on the
+boards selected by a boolean mask.
+"""
+import numpy as np
+
+from engine import Piece
+
+# Grid cells hold Color values, as Board.colors does; 0 is clear.
+
+# DX/DY[tile, shape * 4 + rotation] are the tile offsets of each pose. Tiles
+# come first so per-piece reductions run over contiguous rows of K values.
+_OFFSETS = np.array([shape["rotations"] for shape in Piece.SHAPES], dtype=np.int32)
+DX = np.ascontiguousarray(_OFFSETS[:, :, :, 0].reshape(-1, 4).T)
+DY = np.ascontiguousarray(_OFFSETS[:, :, :, 1].reshape(-1, 4).T)
+X_ADJ = np.array([shape["x_adj"] for shape in Piece.SHAPES], dtype=np.int32)
+SHAPE_COLORS = np.array([shape["color"] for shape in Piece.SHAPES], dtype=np.uint8)
+
+
+class BoardBatch:
+	def __init__(self, k, n_columns, n_rows, seed=None, autogen=True):
+		self.k = k
+		self.width = n_columns
+		self.height = n_rows
+		self.rng = np.random.default_rng(seed)
+		self.autogen = autogen
+		self._boards = np.arange(k)
+		self._column_base = (self._boards * n_columns).astype(np.int32)
+
+		self.reset()
+
+	def reset(self):
+		k = self.k
+		self.grid = np.zeros((k, self.height, self.width), dtype=np.uint8)
+		self.columns = np.full((k, self.width), self.height, dtype=np.int32)
+		self.has_piece = np.zeros(k, dtype=bool)
+		self.shape = np.zeros(k, dtype=np.int32)
+		self.x = np.zeros(k, dtype=np.int32)
+		self.y = np.zeros(k, dtype=np.int32)
+		self.rotation = np.zeros(k, dtype=np.int32)
+		self.finalize_ready = np.zeros(k, dtype=bool)
+		self.score = np.zeros(k, dtype=np.int64)
+		self.level = np.ones(k, dtype=np.int64)
+		self.lines = np.zeros(k, dtype=np.int64)
+		self.game_over = np.zeros(k, dtype=bool)
+
+	def _mask(self, mask):
+		if mask is None:
+			return self.has_piece.copy()
+		return self.has_piece & mask
+
+	def tiles(self, x=None, y=None, rotation=None):
+		"""Returns (tx, ty), each (4, K), for every board's piece, optionally
+		at another pose."""
+		x = self.x if x is None else x
+		y = self.y if y is None else y
+		rotation = self.rotation if rotation is None else rotation
+		pose = self.shape * 4 + rotation
+		return (DX.take(pose, axis=1) + x, DY.take(pose, axis=1) + y)
+
+	def _tops(self, tx):
+		"""Returns the column tops under the tiles tx, clamped to the board."""
+		tx = np.clip(tx, 0, self.width - 1)
+		return self.columns.take(self._column_base + tx)
+
+	def piece_fits(self, x, y, rotation):
+		"""Returns a (K,) bool array: True where the piece fits at the pose."""
+		tx, ty = self.tiles(x, y, rotation)
+		inside = (tx >= 0) & (tx < self.width)
+		fits = inside & (ty < self._tops(tx))
+		return fits[0] & fits[1] & fits[2] & fits[3]
+
+	def piece_can_move(self, x_move, y_move):
+		return self.piece_fits(self.x + x_move, self.y + y_move, self.rotation)
+
+	def move_piece(self, x_move, y_move, mask=None):
+		"""Moves pieces where the move fits. Moves may be scalars or (K,) arrays."""
+		ok = self._mask(mask) & self.piece_can_move(x_move, y_move)
+		self.x += np.where(ok, x_move, 0)
+		self.y += np.where(ok, y_move, 0)
+
+	def rotate_piece(self, clockwise=True, mask=None):
+		rotation = (self.rotation + (1 if clockwise else -1)) % 4
+		ok = self._mask(mask) & self.piece_fits(self.x, self.y, rotation)
+		self.rotation = np.where(ok, rotation, self.rotation)
+
+	def drop_piece(self, mask=None):
+		"""Drops pieces one level, or finalizes them after a leeway tick."""
+		active = self._mask(mask)
+		can = self.piece_can_move(0, 1)
+		moving = active & can
+		self.y += moving
+		self.finalize_ready[moving] = False
+
+		stuck = active & ~can
+		lock = stuck & self.finalize_ready
+		self.finalize_ready |= stuck
+		self.finalize_piece(lock)
+		if self.autogen:
+			self.generate_piece(lock)
+
+	def landing_row(self):
+		"""Returns the (K,) rows each piece would rest at if dropped."""
+		tx, ty = self.tiles()
+		rows = self._tops(tx) - (ty - self.y) - 1
+		return np.minimum(np.minimum(rows[0], rows[1]), np.minimum(rows[2], rows[3]))
+
+	def full_drop_piece(self, mask=None):
+		active = self._mask(mask)
+		self.y = np.where(active, self.landing_row(), self.y)
+		self.finalize_piece(active)
+		if self.autogen:
+			self.generate_piece(active)
+
+	def finalize_piece(self, mask):
+		"""Locks the selected pieces into their grids and clears full rows."""
+		boards = self._boards[self._mask(mask)]
+		if not len(boards):
+			return
+
+		tx, ty = self.tiles()
+		tx = tx[:, boards]
+		ty = ty[:, boards]
+		color = np.broadcast_to(SHAPE_COLORS[self.shape[boards]], tx.shape)
+		on_board = (ty >= 0) & (ty < self.height)
+		b4 = np.broadcast_to(boards, tx.shape)
+		self.grid[b4[on_board], ty[on_board], tx[on_board]] = color[on_board]
+
+		grids = self.grid[boards]
+		full = (grids != 0).all(axis=2)
+		cleared = full.sum(axis=1)
+		if cleared.any():
+			# Stable sort puts the full rows on top, in front of the rest
+			grids[full] = 0
+			order = np.argsort(~full, axis=1, kind="stable")
+			grids = np.take_along_axis(grids, order[:, :, None], axis=1)
+			self.grid[boards] = grids
+
+		filled = grids != 0
+		self.columns[boards] = np.where(filled.any(axis=1), filled.argmax(axis=1),
+		                                self.height)
+		self.score[boards] += cleared * cleared * 10
+		self.lines[boards] += cleared
+		self.level[boards] = self.lines[boards] // 10 + 1
+		self.has_piece[boards] = False
+
+	def generate_piece(self, mask=None, shapes=None):
+		"""Spawns new pieces on the selected boards, at random or from shapes,
+		a (K,) array of indexes into Piece.SHAPES."""
+		if mask is None:
+			mask = np.ones(self.k, dtype=bool)
+		boards = self._boards[mask & ~self.game_over]
+		if not len(boards):
+			return
+
+		if shapes is None:
+			shape = self.rng.integers(len(Piece.SHAPES), size=len(boards))
+		else:
+			shape = shapes[boards]
+		self.shape[boards] = shape
+		self.x[boards] = self.width // 2 - X_ADJ[shape]
+		self.y[boards] = 0
+		self.rotation[boards] = 0
+		self.has_piece[boards] = True
+
+		spawn = np.zeros(self.k, dtype=bool)
+		spawn[boards] = True
+		blocked = spawn & ~self.piece_can_move(0, 0)
+		if blocked.any():
+			# Show the piece on the board and end the game
+			self.finalize_piece(blocked)
+			self.game_over |= blocked
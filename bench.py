@@ -0,0 +1,472 @@
+"""Headless benchmarks for the tetris engine.
+
+`python bench.py` prints throughput numbers. `python bench.py micro -o
+results.json` runs the micro-benchmarks and saves them, and `python
+bench.py compare baseline.json` runs them again and flags regressions
+against a saved baseline.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+from random import Random
+
+from engine import Board, Color, Piece, TextView
+
+
+def bench_placements(n=20000, seed=1, width=10, height=20):
+	"""Locks n pieces with random rotations and shifts, returning placements/sec."""
+	b = Board(width, height)
+	b.rand.seed(seed)
+	b.generate_piece()
+	r = Random(seed + 1)
+
+	start = time.perf_counter()
+	for i in range(n):
+		if b.game_over:
+			b.reset()
+			b.generate_piece()
+		for _ in range(r.randrange(4)):
+			b.rotate_piece()
+		b.move_piece(r.randrange(-5, 6), 0)
+		b.full_drop_piece()
+	return n / (time.perf_counter() - start)
+
+
+def bench_batch_steps(k=10000, steps=50, seed=1):
+	"""Steps k games with a random shift plus a gravity tick, both as k
+	Boards and as one BoardBatch. Returns (board steps/sec, batch steps/sec)."""
+	import numpy as np
+	from batch import BoardBatch
+
+	r = Random(seed)
+	boards = [Board(10, 20) for i in range(k)]
+	for b in boards:
+		b.rand.seed(r.random())
+		b.generate_piece()
+	start = time.perf_counter()
+	for i in range(steps):
+		for b in boards:
+			b.move_piece(r.randrange(-1, 2), 0)
+			b.drop_piece()
+	scalar = k * steps / (time.perf_counter() - start)
+
+	bb = BoardBatch(k, 10, 20, seed=seed)
+	bb.generate_piece()
+	rng = np.random.default_rng(seed)
+	start = time.perf_counter()
+	for i in range(steps):
+		bb.move_piece(rng.integers(-1, 2, size=k), 0)
+		bb.drop_piece()
+	batch = k * steps / (time.perf_counter() - start)
+	return scalar, batch
+
+
+def bench_env_steps(n=256, steps=200, processes=1, seed=1):
+	"""Steps a VecEnv of n boards with random actions, returning board
+	steps/sec."""
+	import numpy as np
+	import env
+
+	with env.VecEnv(n, processes=processes) as e:
+		e.reset(seeds=range(seed, seed + n))
+		actions = np.random.default_rng(seed).integers(env.N_ACTIONS, size=(steps, n))
+		start = time.perf_counter()
+		for a in actions:
+			e.step(a)
+		return n * steps / (time.perf_counter() - start)
+
+
+def bench_stream(frames=5000, seed=1, keyframe_every=60):
+	"""Streams a game played with random inputs, once as encoded deltas and
+	once as TextView.get_str() dumps. Returns ((delta bytes/frame, encode
+	us/frame), (dump bytes/frame, dump us/frame))."""
+	import replay
+	from stream import FrameEncoder
+
+	def play(frame):
+		b = Board(10, 20, seed=seed)
+		b.generate_piece()
+		r = Random(seed)
+		ops = (replay.DROP, replay.LEFT, replay.RIGHT, replay.ROTATE_CW, replay.FULL_DROP)
+		sent = 0
+		elapsed = 0.0
+		for i in range(frames):
+			if b.game_over:
+				b.reset()
+				b.generate_piece()
+			replay.apply(b, r.choice(ops))
+			start = time.perf_counter()
+			data = frame(b)
+			elapsed += time.perf_counter() - start
+			sent += len(data or b"")
+		return sent / frames, elapsed * 1e6 / frames
+
+	encoders = {}
+	def delta(b):
+		# play() makes a new board for each run
+		if b not in encoders:
+			encoders[b] = FrameEncoder(b, keyframe_every)
+		return encoders[b].encode()
+	v = TextView()
+	def dump(b):
+		b.render(v)
+		return v.get_str().encode()
+	return play(delta), play(dump)
+
+
+def _pygame_view():
+	"""Returns a PygameView drawing to an offscreen surface."""
+	os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+	import pygame
+	from tetris import PygameView
+
+	pygame.init()
+	pygame.font.init()
+	fonts = {"game_over" : pygame.font.SysFont("ni7seg", 60),
+	         "score" : pygame.font.SysFont("ni7seg", 18)}
+	return PygameView(pygame.Surface((600, 600)), fonts)
+
+
+def bench_draw_board(n=500):
+	"""Draws a full 10x20 board n times, returning milliseconds per frame."""
+	v = _pygame_view()
+	v.set_size(10, 20)
+	colors = Color.colors()
+	for y in range(20):
+		for x in range(10):
+			v.render_tile(x, y, colors[(x + y) % len(colors)])
+	cells = v.get_cells()
+
+	start = time.perf_counter()
+	for i in range(n):
+		v.draw_board(cells)
+	return (time.perf_counter() - start) * 1000 / n
+
+
+def bench_idle_cpu(seconds=3.0, event_driven=True):
+	"""Runs the game loop with no input for a few seconds, returning the
+	fraction of one core it used and the frames rendered per second."""
+	os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+	import pygame
+	from tetris import Tetris, PygameView
+
+	t = Tetris(PygameView, event_driven=event_driven)
+	t.init()
+	t.clock = pygame.time.Clock()
+	pygame.time.set_timer(t.DROP_EVENT, t.drop_speed)
+	frames = [0]
+	render_frame = t.render_frame
+	def counted_render_frame():
+		frames[0] += 1
+		render_frame()
+	t.render_frame = counted_render_frame
+
+	wall = time.perf_counter()
+	cpu = time.process_time()
+	while time.perf_counter() - wall < seconds:
+		t.run_frame()
+	cpu = time.process_time() - cpu
+	pygame.time.set_timer(t.DROP_EVENT, 0)
+	wall = time.perf_counter() - wall
+	return cpu / wall, frames[0] / wall
+
+
+# Micro-benchmarks. Each one takes n and returns the seconds spent on n calls
+# of a single operation, doing any setup outside the timed region.
+MICRO = {}
+
+def micro(name, n):
+	def register(func):
+		MICRO[name] = (func, n)
+		return func
+	return register
+
+
+def _midgame_board(seed=1, placements=6):
+	"""Returns a 10x20 board with a small random stack and a piece in play."""
+	b = Board(10, 20)
+	b.rand.seed(seed)
+	r = Random(seed)
+	b.generate_piece()
+	for i in range(placements):
+		for _ in range(r.randrange(4)):
+			b.rotate_piece()
+		b.move_piece(r.randrange(-4, 5), 0)
+		b.full_drop_piece()
+	assert not b.game_over
+	return b
+
+def _fresh_boards(n, seed=1):
+	boards = []
+	for i in range(n):
+		b = Board(10, 20)
+		b.rand.seed(seed + i)
+		b.generate_piece()
+		boards.append(b)
+	return boards
+
+
+@micro("piece_iter", 50000)
+def micro_piece_iter(n):
+	p = Piece(3, 4, Piece.T_SHAPE, Color.RED, 1)
+	start = time.perf_counter()
+	for i in range(n):
+		for tile in p:
+			pass
+	return time.perf_counter() - start
+
+@micro("piece_can_move", 50000)
+def micro_piece_can_move(n):
+	can_move = _midgame_board().piece_can_move
+	start = time.perf_counter()
+	for i in range(n):
+		can_move(1, 0)
+	return time.perf_counter() - start
+
+@micro("piece_can_rotate", 50000)
+def micro_piece_can_rotate(n):
+	can_rotate = _midgame_board().piece_can_rotate
+	start = time.perf_counter()
+	for i in range(n):
+		can_rotate(True)
+	return time.perf_counter() - start
+
+@micro("drop_piece", 5000)
+def micro_drop_piece(n):
+	boards = _fresh_boards(n)
+	start = time.perf_counter()
+	for b in boards:
+		b.drop_piece()
+	return time.perf_counter() - start
+
+@micro("full_drop_piece", 5000)
+def micro_full_drop_piece(n):
+	boards = _fresh_boards(n)
+	start = time.perf_counter()
+	for b in boards:
+		b.full_drop_piece()
+	return time.perf_counter() - start
+
+def _micro_finalize(lines):
+	def micro_finalize(n):
+		boards = []
+		for i in range(n):
+			b = Board(10, 20, autogen=False)
+			for y in range(20 - lines, 20):
+				for x in range(1, 10):
+					b.set_tile_color(x, y, Color.BLUE)
+			# A vertical I in the empty left column completes `lines` rows
+			b.piece = Piece(0, 16, Piece.I_SHAPE, Color.RED, 1)
+			boards.append(b)
+		start = time.perf_counter()
+		for b in boards:
+			b.finalize_piece()
+		return time.perf_counter() - start
+	return micro_finalize
+
+for _lines in range(5):
+	micro("finalize_piece[{}]".format(_lines), 5000)(_micro_finalize(_lines))
+del _lines
+
+@micro("legal_placements", 2000)
+def micro_legal_placements(n):
+	legal_placements = _midgame_board().legal_placements
+	start = time.perf_counter()
+	for i in range(n):
+		legal_placements()
+	return time.perf_counter() - start
+
+@micro("snapshot_restore", 20000)
+def micro_snapshot_restore(n):
+	"""A search step: snapshot, try a placement, roll back."""
+	b = _midgame_board()
+	snapshot = b.snapshot
+	restore = b.restore
+	start = time.perf_counter()
+	for i in range(n):
+		restore(snapshot())
+	return time.perf_counter() - start
+
+@micro("snapshot_restore_full_drop", 5000)
+def micro_snapshot_restore_full_drop(n):
+	b = _midgame_board()
+	state = b.snapshot()
+	start = time.perf_counter()
+	for i in range(n):
+		b.full_drop_piece()
+		b.restore(state)
+	return time.perf_counter() - start
+
+@micro("board_render_text", 5000)
+def micro_board_render_text(n):
+	b = _midgame_board()
+	v = TextView()
+	start = time.perf_counter()
+	for i in range(n):
+		b.render(v)
+	return time.perf_counter() - start
+
+@micro("text_get_lines", 5000)
+def micro_text_get_lines(n):
+	b = _midgame_board()
+	v = TextView()
+	b.render(v)
+	start = time.perf_counter()
+	for i in range(n):
+		v.get_lines()
+	return time.perf_counter() - start
+
+@micro("pygame_show", 2000)
+def micro_pygame_show(n):
+	"""A typical frame: the piece moved, updating the attached view, then
+	show."""
+	b = _midgame_board()
+	v = _pygame_view()
+	b.attach(v)
+	v.show()
+	start = time.perf_counter()
+	for i in range(n):
+		b.move_piece(1 if i % 2 else -1, 0)
+		v.show()
+		v.take_dirty()
+	return time.perf_counter() - start
+
+@micro("pygame_show_full", 500)
+def micro_pygame_show_full(n):
+	"""Render and show with a full repaint every frame."""
+	b = _midgame_board()
+	v = _pygame_view()
+	start = time.perf_counter()
+	for i in range(n):
+		b.render(v)
+		v.shown = None
+		v.show()
+		v.take_dirty()
+	return time.perf_counter() - start
+
+
+def run_micro(names=None, repeat=7):
+	"""Runs the micro-benchmarks, returning {name: nanoseconds per call}.
+	Each is the best of `repeat` runs with the garbage collector off; ones
+	needing pygame are skipped if it isn't installed."""
+	results = {}
+	for name, (func, n) in MICRO.items():
+		if names and name not in names:
+			continue
+		times = []
+		try:
+			for i in range(repeat):
+				gc.collect()
+				gc.disable()
+				try:
+					times.append(func(n))
+				finally:
+					gc.enable()
+		except ImportError as e:
+			print("{}: skipped ({})".format(name, e), file=sys.stderr)
+			continue
+		results[name] = min(times) * 1e9 / n
+	return results
+
+def save_results(results, path):
+	with open(path, "w") as f:
+		json.dump({"python" : platform.python_version(),
+		           "machine" : platform.machine(),
+		           "results" : results}, f, indent=2, sort_keys=True)
+
+def load_results(path):
+	with open(path) as f:
+		return json.load(f)["results"]
+
+def compare(baseline, current, threshold=0.10):
+	"""Prints both runs side by side, returning the names of benchmarks
+	slower than baseline by more than threshold."""
+	regressions = []
+	print("{:<22} {:>12} {:>12} {:>8}".format("benchmark", "baseline ns", "current ns", "change"))
+	for name in sorted(set(baseline) | set(current)):
+		if name not in baseline or name not in current:
+			print("{:<22} {:>12} {:>12}".format(name, *(
+				"{:.0f}".format(r[name]) if name in r else "-" for r in (baseline, current))))
+			continue
+		change = current[name] / baseline[name] - 1
+		flag = ""
+		if change > threshold:
+			regressions.append(name)
+			flag = "  REGRESSION"
+		print("{:<22} {:>12.0f} {:>12.0f} {:>+7.1%}{}".format(
+			name, baseline[name], current[name], change, flag))
+	return regressions
+
+
+def print_micro(results):
+	for name, ns in results.items():
+		print("{:<22} {:>10.0f} ns".format(name, ns))
+
+def throughput():
+	print("placements/sec: {:.0f}".format(bench_placements()))
+	print("placements/sec (10x200): {:.0f}".format(bench_placements(height=200)))
+	try:
+		scalar, batch = bench_batch_steps()
+	except ImportError:
+		print("batch: numpy not installed, skipped")
+	else:
+		print("board steps/sec: {:.0f}, batch steps/sec: {:.0f} ({:.1f}x)".format(
+			scalar, batch, batch / scalar))
+		for processes in sorted({1, os.cpu_count() or 1}):
+			print("env steps/sec ({} processes): {:.0f}".format(
+				processes, bench_env_steps(processes=processes)))
+	(delta_bytes, delta_us), (dump_bytes, dump_us) = bench_stream()
+	print("stream: deltas {:.1f} bytes, {:.1f} us/frame; text dumps {:.1f} bytes, "
+	      "{:.1f} us/frame".format(delta_bytes, delta_us, dump_bytes, dump_us))
+	print("stream at 60 frames/sec: {:.0f} bytes/sec vs {:.0f}".format(
+		delta_bytes * 60, dump_bytes * 60))
+	try:
+		draw_ms = bench_draw_board()
+	except ImportError:
+		print("draw_board: pygame not installed, skipped")
+	else:
+		print("draw_board (full 10x20): {:.3f} ms/frame".format(draw_ms))
+		for name, event_driven in (("polling", False), ("event-driven", True)):
+			print("idle, {} loop: {:.1%} CPU, {:.1f} frames/sec".format(
+				name, *bench_idle_cpu(event_driven=event_driven)))
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Tetris engine benchmarks.")
+	sub = parser.add_subparsers(dest="command")
+	sub.add_parser("throughput", help="placement, batch and rendering throughput")
+	micro_parser = sub.add_parser("micro", help="run the micro-benchmarks")
+	micro_parser.add_argument("-o", "--output", help="write results to this JSON file")
+	micro_parser.add_argument("names", nargs="*")
+	compare_parser = sub.add_parser("compare", help="flag regressions against a baseline")
+	compare_parser.add_argument("baseline")
+	compare_parser.add_argument("current", nargs="?",
+	                            help="results JSON to compare (default: run now)")
+	compare_parser.add_argument("--threshold", type=float, default=0.10,
+	                            help="allowed slowdown before flagging (default 0.10)")
+	args = parser.parse_args(argv)
+
+	if args.command == "micro":
+		results = run_micro(args.names)
+		print_micro(results)
+		if args.output:
+			save_results(results, args.output)
+	elif args.command == "compare":
+		baseline = load_results(args.baseline)
+		if args.current:
+			current = load_results(args.current)
+		else:
+			current = run_micro(list(baseline))
+		if compare(baseline, current, args.threshold):
+			return 1
+	else:
+		throughput()
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -1,17 +1,21 @@
 
-from collections import defaultdict
+from collections import namedtuple
+from enum import IntEnum
+import sys
 from random import Random
 
 # Some interfaces
-class Color:
-	CLEAR = "clear"
-	RED = "red"
-	BLUE = "blue"
-	GREEN = "green"
-	YELLOW = "yellow"
-	MAGENTA = "magenta"
-	CYAN = "cyan"
-	ORANGE = "orange"
+class Color(IntEnum):
+	"""Tile colors. They're small integers so grids of them fit in bytes,
+	with 0 for an empty square."""
+	CLEAR = 0
+	RED = 1
+	BLUE = 2
+	GREEN = 3
+	YELLOW = 4
+	MAGENTA = 5
+	CYAN = 6
+	ORANGE = 7
 
 	@staticmethod
 	def colors():
@@ -19,10 +23,21 @@ class Color:
 			    Color.MAGENTA, Color.CYAN, Color.ORANGE)
 
 class ViewBase:
+	"""A view keeps its own copy of the board in `rows`, a bytearray of
+	Color values per row, with the piece in play drawn over the tiles.
+
+	Board.render() redraws everything. A view attached to a board with
+	Board.attach() is instead kept up to date by tile_changed(),
+	rows_cleared() and piece_changed() calls as the board changes, plus
+	set_score() and set_level() when those do."""
+
 	def __init__(self):
 		self.rows = []
 		self.width = 0
 		self.height = 0
+		# {(x, y): tile color} under each square of the piece drawn in rows
+		self.covered = {}
+		self.piece_color = None
 
 	def set_size(self, columns, rows):
 		self.width = columns
@@ -30,25 +45,92 @@ class ViewBase:
 		self.clear()
 
 	def clear(self):
-		self.rows = [[Color.CLEAR] * self.width for i in range(self.height)]
+		self.rows = [bytearray(self.width) for i in range(self.height)]
+		self.covered = {}
 
 	def render_tile(self, x, y, color):
 		if (0 <= x < self.width and 0 <= y < self.height):
 			self.rows[y][x] = color
 
+	def render_row(self, y, colors):
+		"""Draws a whole row of tiles, given as bytes of Color values."""
+		self.rows[y][:] = colors
+
+	def render_ghost(self, x, y, color):
+		"""Marks where the current piece would land. Optional for views."""
+		pass
+
+	def clear_ghost(self):
+		"""Forgets the ghost marked by render_ghost()."""
+		pass
+
+	def render_piece(self, piece):
+		"""Draws the piece in play over the tiles."""
+		rows = self.rows
+		covered = self.covered
+		self.piece_color = piece.color
+		for x, y in piece:
+			if 0 <= x < self.width and 0 <= y < self.height:
+				covered[(x, y)] = rows[y][x]
+				rows[y][x] = piece.color
+
+	def lift_piece(self):
+		"""Removes the piece drawn by render_piece(), returning the squares
+		it covered."""
+		rows = self.rows
+		for (x, y), color in self.covered.items():
+			rows[y][x] = color
+		squares = list(self.covered)
+		self.covered = {}
+		return squares
+
+	def set_score(self, score):
+		pass
+
+	def set_level(self, level):
+		pass
+
+	def close(self):
+		"""Puts back anything the view changed outside itself. Safe to call
+		more than once."""
+		pass
+
+	# Changes from an attached board
+
+	def tile_changed(self, x, y, color):
+		if (x, y) in self.covered:
+			self.covered[(x, y)] = color
+		else:
+			self.render_tile(x, y, color)
+
+	def rows_cleared(self, cleared):
+		"""Removes rows, moving the rows above them down."""
+		squares = self.lift_piece()
+		rows = self.rows
+		kept = [row for y, row in enumerate(rows) if y not in cleared]
+		rows[:] = [bytearray(self.width) for i in range(self.height - len(kept))] + kept
+		# The piece stays where it was
+		for x, y in squares:
+			self.covered[(x, y)] = rows[y][x]
+			rows[y][x] = self.piece_color
+
+	def piece_changed(self, piece, ghost_y):
+		"""The piece in play moved, rotated or was replaced, or there's no
+		longer one if piece is None. ghost_y is how far it would drop."""
+		self.lift_piece()
+		self.clear_ghost()
+		if piece is not None:
+			for x, y in piece:
+				self.render_ghost(x, y + ghost_y, piece.color)
+			self.render_piece(piece)
+
 class TextView(ViewBase):
 	"""Renders a board as text."""
 
-	COLOR_CHAR = {
-		Color.CLEAR : '.',
-		Color.RED : '*',
-		Color.BLUE : '#',
-		Color.GREEN : 'o',
-		Color.YELLOW : 'O',
-		Color.MAGENTA : '%',
-		Color.CYAN : '&',
-		Color.ORANGE : '$',
-	}
+	# Indexed by Color
+	COLOR_CHAR = ".*#oO%&$"
+	# For bytes.translate(), turning a row of colors into its characters
+	_CHAR_TABLE = bytes.maketrans(bytes(range(len(COLOR_CHAR))), COLOR_CHAR.encode())
 
 	def __init__(self, surf=None):
 		ViewBase.__init__(self)
@@ -58,12 +140,90 @@ class TextView(ViewBase):
 		print(str_)
 
 	def get_str(self):
-		str_ = "\n"
-		for column in self.rows:
-			for item in column:
-				str_ += TextView.COLOR_CHAR[item]
-			str_ += "\n"
-		return str_
+		return "\n" + "".join(line + "\n" for line in self.get_lines())
+
+	def get_lines(self):
+		table = TextView._CHAR_TABLE
+		return [row.translate(table).decode() for row in self.rows]
+
+class AnsiView(TextView):
+	"""Renders a board to an ANSI terminal, redrawing only what changed.
+
+	The previous frame is kept, and each show() writes cursor moves plus
+	the changed runs of characters in a single write."""
+
+	def __init__(self, surf=None, out=None):
+		TextView.__init__(self, surf)
+		self.out = out if out is not None else sys.stdout
+		self.score = None
+		self.level = None
+		self.drawn = None
+		self.game_over_shown = False
+		self.cursor_hidden = False
+
+	def set_score(self, score):
+		self.score = score
+
+	def set_level(self, level):
+		self.level = level
+
+	def get_frame(self):
+		lines = self.get_lines()
+		if self.score is not None or self.level is not None:
+			lines.append("SCORE {:06d} LEVEL {:02d}".format(self.score or 0, self.level or 0))
+		return lines
+
+	def show(self):
+		lines = self.get_frame()
+		drawn = self.drawn
+		if drawn is None or len(drawn) != len(lines):
+			# Clear the screen, hide the cursor and draw everything
+			parts = ["\x1b[2J\x1b[?25l"]
+			self.cursor_hidden = True
+			for y, line in enumerate(lines):
+				parts.append("\x1b[{};1H{}".format(y + 1, line))
+		else:
+			parts = []
+			for y, (line, old) in enumerate(zip(lines, drawn)):
+				if line != old:
+					parts.extend(self._diff_line(y, line, old))
+		if parts:
+			parts.append("\x1b[{};1H".format(len(lines) + 1))
+			self.out.write("".join(parts))
+			self.out.flush()
+		self.drawn = lines
+
+	def _diff_line(self, y, line, old):
+		"""Yields cursor moves and text for the changed runs of one line."""
+		if len(line) != len(old):
+			yield "\x1b[{};1H{}\x1b[K".format(y + 1, line)
+			return
+		x = 0
+		n = len(line)
+		while x < n:
+			if line[x] == old[x]:
+				x += 1
+				continue
+			start = x
+			while x < n and line[x] != old[x]:
+				x += 1
+			yield "\x1b[{};{}H{}".format(y + 1, start + 1, line[start:x])
+
+	def show_game_over(self):
+		if self.game_over_shown:
+			return
+		self.game_over_shown = True
+		self.out.write("\x1b[{};1HGAME OVER\x1b[?25h\n".format(len(self.drawn or ()) + 1))
+		self.out.flush()
+		self.cursor_hidden = False
+
+	def close(self):
+		"""Shows the cursor again, below the board, if show() hid it."""
+		if not self.cursor_hidden:
+			return
+		self.out.write("\x1b[{};1H\x1b[?25h\n".format(len(self.drawn or ()) + 1))
+		self.out.flush()
+		self.cursor_hidden = False
 
 class Piece:
 	L_SHAPE = {"tiles" : ((0,0), (0,1), (0,2), (1,2)),
@@ -96,30 +256,25 @@ class Piece:
 			   "color" : Color.RED}
 	SHAPES = (L_SHAPE, R_SHAPE, O_SHAPE, T_SHAPE, S_SHAPE, Z_SHAPE, I_SHAPE)
 
+	__slots__ = ("x", "y", "shape", "color", "rotation", "offsets")
+
 	def __init__(self, x, y, shape, color, rot=0):
 		self.x = x
 		self.y = y
 		self.shape = shape
 		self.color = color
 		self.rotation = rot
+		self.offsets = shape["rotations"]
 
 	def move(self, x, y):
 		self.x += x
 		self.y += y
 
 	def __iter__(self):
-		for x_offset, y_offset in self.shape["tiles"]:
-			if self.rotation == 0:
-				yield (self.x + x_offset, self.y + y_offset)
-			elif self.rotation == 1:
-				yield (self.x - y_offset + self.shape["y_adj"], 
-					   self.y + x_offset)
-			elif self.rotation == 2:
-				yield (self.x - x_offset + self.shape["x_adj"],
-					   self.y - y_offset + self.shape["y_adj"])
-			elif self.rotation == 3:
-				yield (self.x + y_offset,
-					   self.y - x_offset + self.shape["x_adj"] )
+		x = self.x
+		y = self.y
+		for x_offset, y_offset in self.offsets[self.rotation]:
+			yield (x + x_offset, y + y_offset)
 
 	def render(self, v):
 		for x, y in self:
@@ -137,58 +292,380 @@ class Piece:
 		return p
 
 
+# Milliseconds between gravity drops at each level
+LEVEL_SPEEDS = {
+	1 : 1000,
+	2 : 750,
+	3 : 500,
+	4 : 400,
+	5 : 300,
+	6 : 250,
+	7 : 200,
+	8 : 150,
+	9 : 125,
+	10 : 100,
+	11 : 90,
+	12 : 80,
+	13 : 75
+}
+
+def level_speed(level):
+	"""Returns the milliseconds between gravity drops at a level."""
+	if level > 13:
+		return 75 - (5 * (level - 13))
+	else:
+		return LEVEL_SPEEDS[level]
+
+
+def _rotate_offsets(shape, rotation):
+	"""Returns the tile offsets of a shape in the given rotation."""
+	x_adj = shape["x_adj"]
+	y_adj = shape["y_adj"]
+	offsets = []
+	for x, y in shape["tiles"]:
+		if rotation == 0:
+			offsets.append((x, y))
+		elif rotation == 1:
+			offsets.append((y_adj - y, x))
+		elif rotation == 2:
+			offsets.append((x_adj - x, y_adj - y))
+		elif rotation == 3:
+			offsets.append((y, x_adj - x))
+	return tuple(offsets)
+
+def _row_masks(offsets):
+	"""Returns (left, right, ((dy, mask), ...)) for a set of tile offsets.
+
+	Each mask holds the tiles in row dy, shifted so that bit 0 is the
+	leftmost column the piece covers."""
+	left = min(x for x, y in offsets)
+	right = max(x for x, y in offsets)
+	masks = {}
+	for x, y in offsets:
+		masks[y] = masks.get(y, 0) | (1 << (x - left))
+	return (left, right, tuple(sorted(masks.items())))
+
+def _bottom_profile(offsets):
+	"""Returns ((dx, dy), ...) giving the lowest tile in each column."""
+	bottom = {}
+	for x, y in offsets:
+		bottom[x] = max(bottom.get(x, y), y)
+	return tuple(sorted(bottom.items()))
+
+def _symmetry(rotations, rotation):
+	"""Returns (r, dx, dy) such that the given rotation at (x, y) covers the
+	same tiles as the lowest equivalent rotation r at (x + dx, y + dy)."""
+	def normal(offsets):
+		left = min(x for x, y in offsets)
+		top = min(y for x, y in offsets)
+		return left, top, frozenset((x - left, y - top) for x, y in offsets)
+	left, top, tiles = normal(rotations[rotation])
+	for r in range(rotation + 1):
+		r_left, r_top, r_tiles = normal(rotations[r])
+		if r_tiles == tiles:
+			return (r, left - r_left, top - r_top)
+
+# Precompute every rotation once so the hot paths are plain tuple lookups.
+for _shape in Piece.SHAPES:
+	_shape["rotations"] = tuple(_rotate_offsets(_shape, r) for r in range(4))
+	_shape["masks"] = tuple(_row_masks(o) for o in _shape["rotations"])
+	_shape["profiles"] = tuple(_bottom_profile(o) for o in _shape["rotations"])
+	_shape["symmetry"] = tuple(_symmetry(_shape["rotations"], r) for r in range(4))
+del _shape
+
+
+_ZOBRIST_RAND = Random(0x2b0b)
+for _shape in Piece.SHAPES:
+	_shape["keys"] = tuple(_ZOBRIST_RAND.getrandbits(64) for r in range(4))
+del _shape
+
+_zobrist_tables = {}
+
+def _zobrist_table(width, height):
+	"""Returns random 64 bit keys, one per tile, as table[y][x], and the
+	same keys combined 8 columns at a time, as chunks[y][i][bits], where
+	bits are the filled tiles in columns 8 * i to 8 * i + 7. Boards of the
+	same size share tables so their hashes can be compared."""
+	tables = _zobrist_tables.get((width, height))
+	if tables is None:
+		rand = Random(width * 65536 + height)
+		table = tuple(tuple(rand.getrandbits(64) for x in range(width))
+		              for y in range(height))
+		chunks = []
+		for keys in table:
+			row = []
+			for i in range(0, width, 8):
+				combined = [0] * 256
+				for bits in range(1, 256):
+					low = bits & -bits
+					x = i + low.bit_length() - 1
+					combined[bits] = combined[bits ^ low] ^ (keys[x] if x < width else 0)
+				row.append(tuple(combined))
+			chunks.append(tuple(row))
+		tables = _zobrist_tables[width, height] = (table, tuple(chunks))
+	return tables
+
+
+def _replace(row, x, value):
+	"""Returns a copy of the bytes row with item x replaced."""
+	return row[:x] + bytes((value,)) + row[x + 1:]
+
+
+# Everything needed to put a Board back as it was, see Board.snapshot()
+BoardState = namedtuple("BoardState", ("rows", "solid", "row_counts", "colors",
+	"columns", "zobrist", "piece", "queue", "finalize_ready", "score",
+	"level", "lines", "game_over", "rand"))
+
+
 class Board:
-	def __init__(self, n_columns, n_rows, board = None, autogen = True):
+	"""A tetris board.
+
+	Occupancy is kept as one integer bitmask per row (bit x set means column
+	x is filled), with a parallel plane of colors for rendering. Pieces
+	collide with anything at or below the top of a column, so `solid` keeps
+	a second set of row masks with every column filled from its top down.
+
+	Rows of the color plane are bytes of Color values, replaced rather than
+	modified, so snapshots can share them.
+
+	`zobrist` is a Zobrist hash of which tiles are filled, kept up to date
+	as tiles change; state_key() adds the piece in play.
+
+	Views attached with attach() are told about each change as it happens
+	(see ViewBase), and redrawn in full when the whole board is replaced.
+	"""
+	def __init__(self, n_columns, n_rows, board = None, autogen = True, seed = None):
+		self.width = n_columns
 		self.height = n_rows
-		self.columns = [self.height] * n_columns
-		self.rand = Random()
+		self.full_mask = (1 << n_columns) - 1
+		self.seed = seed
+		self.rand = Random(seed)
+		self.zobrist_table, self.zobrist_chunks = _zobrist_table(n_columns, n_rows)
 		self.autogen = autogen
+		# Bumped on every visible change, so views can skip redundant frames
+		self.revision = 0
+		self.views = []
 
 		self.reset()
 
 	def reset(self):
+		self.revision += 1
 		self.piece = None
+		# Shapes already drawn for preview(), next first
+		self.queue = []
 		self.finalize_ready = False
-		self.tiles = defaultdict(lambda:Color.CLEAR)
+		self.columns = [self.height] * self.width
+		self.rows = [0] * self.height
+		self.solid = [0] * self.height
+		self.row_counts = [0] * self.height
+		self.colors = [bytes(self.width)] * self.height
+		self.zobrist = 0
 		self.score = 0
 		self.level = 1
 		self.lines = 0
 		self.game_over = False
+		# self.rand.getstate() as of the last snapshot, None once a piece
+		# has been drawn since
+		self._rand_state = None
+		self._redraw()
 
-	def clear_tile(self, x, y):
-		self.tiles[(x,y)] = Color.CLEAR
+	def attach(self, v):
+		"""Draws the board to a view and keeps it up to date from then on."""
+		self.views.append(v)
+		self.render(v)
+
+	def detach(self, v):
+		self.views.remove(v)
 
-		# Move all the tiles above this row down one space
-		for y_tile in range(y, self.columns[x] - 1, -1):
-			self.tiles[(x, y_tile)] = self.tiles[(x, y_tile - 1)]
+	def _redraw(self):
+		for v in self.views:
+			self.render(v)
 
-		# And reset the top of of the columns
-		while (self.columns[x] < self.height and 
-		       self.tiles[(x, self.columns[x])] == Color.CLEAR):
-			self.columns[x] += 1
+	def _piece_changed(self):
+		p = self.piece
+		ghost_y = 0 if p is None else self.landing_row(p) - p.y
+		for v in self.views:
+			v.piece_changed(p, ghost_y)
+
+	def clear_tile(self, x, y):
+		"""Removes a single tile, moving the tiles above it down one space."""
+		bit = 1 << x
+		rows = self.rows
+		colors = self.colors
+		top = self.columns[x]
+		if y < top:
+			return
+
+		self.zobrist ^= self._rows_hash(top, y + 1)
+		for y_tile in range(y, top, -1):
+			if rows[y_tile - 1] & bit:
+				rows[y_tile] |= bit
+			else:
+				rows[y_tile] &= ~bit
+			colors[y_tile] = _replace(colors[y_tile], x, colors[y_tile - 1][x])
+		rows[top] &= ~bit
+		colors[top] = _replace(colors[top], x, Color.CLEAR)
+		for y_tile in range(top, y + 1):
+			self.row_counts[y_tile] = bin(rows[y_tile]).count("1")
+		self.zobrist ^= self._rows_hash(top, y + 1)
+		self.revision += 1
+
+		self.columns[x] = self._column_top(x, top)
+		self._update_solid(top)
+		if self.views:
+			for v in self.views:
+				for y_tile in range(top, y + 1):
+					v.tile_changed(x, y_tile, colors[y_tile][x])
+			self._piece_changed()
 
 	def clear_row(self, row):
-		for col in range(len(self.columns)):
-			self.clear_tile(col, row)
+		"""Removes a row, moving everything above it down one space."""
+		self.clear_rows((row,))
+
+	def clear_rows(self, cleared):
+		"""Removes several rows at once, compacting the rows above them in a
+		single pass."""
+		cleared = set(cleared)
+		self.revision += 1
+		# Everything above the stack is empty and stays empty
+		start = min(min(self.columns), min(cleared))
+		stop = max(cleared) + 1
+		keep = [y for y in range(start, stop) if y not in cleared]
+		n = len(cleared)
+		new_start = start + n
+		self.zobrist ^= self._rows_hash(start, stop)
+
+		for name in ("rows", "row_counts", "colors"):
+			plane = getattr(self, name)
+			plane[new_start:stop] = [plane[y] for y in keep]
+		for y in range(start, new_start):
+			self.rows[y] = 0
+			self.row_counts[y] = 0
+			self.colors[y] = bytes(self.width)
+		self.zobrist ^= self._rows_hash(new_start, stop)
+
+		self._update_solid(start)
+		self._update_columns(start)
+		if self.views:
+			for v in self.views:
+				v.rows_cleared(cleared)
+			# The piece's landing row, and so its ghost, may have moved
+			if self.piece is not None:
+				self._piece_changed()
+
+	def load_rows(self, rows, color=Color.BLUE):
+		"""Replaces every tile with the given row masks, in one color."""
+		width = self.width
+		self.revision += 1
+		self.rows = list(rows)
+		self.row_counts = [bin(mask).count("1") for mask in rows]
+		self.colors = [bytes(color if mask >> x & 1 else Color.CLEAR for x in range(width))
+		               if mask else bytes(width) for mask in rows]
+		self._update_solid(0)
+		self._update_columns(0)
+		self.zobrist = self._rows_hash(0, self.height)
+		self._redraw()
+
+	def _rows_hash(self, start, stop):
+		"""Returns the Zobrist keys of the filled tiles in rows start..stop
+		xor'd together."""
+		h = 0
+		chunks = self.zobrist_chunks
+		rows = self.rows
+		for y in range(start, stop):
+			mask = rows[y]
+			if mask:
+				for combined in chunks[y]:
+					h ^= combined[mask & 255]
+					mask >>= 8
+		return h
+
+	def state_key(self):
+		"""Returns a hash of the filled tiles and the piece in play."""
+		p = self.piece
+		if p is None:
+			return self.zobrist
+		return self.zobrist ^ hash((p.shape["keys"][p.rotation], p.x, p.y))
+
+	def _update_columns(self, start):
+		"""Recomputes the column tops from the solid masks, for every column
+		whose top is at or below row start."""
+		solid = self.solid
+		columns = self.columns
+		seen = solid[start - 1] if start > 0 else 0
+		for x in range(self.width):
+			if not seen >> x & 1:
+				columns[x] = self.height
+		for y in range(start, self.height):
+			new = solid[y] & ~seen
+			while new:
+				low = new & -new
+				columns[low.bit_length() - 1] = y
+				new ^= low
+			seen = solid[y]
+
+	def _column_top(self, x, start):
+		"""Returns the first filled row in column x at or below start."""
+		bit = 1 << x
+		rows = self.rows
+		for y in range(start, self.height):
+			if rows[y] & bit:
+				return y
+		return self.height
+
+	def _update_solid(self, start):
+		"""Rebuilds the solid masks from row start down."""
+		rows = self.rows
+		solid = self.solid
+		acc = solid[start - 1] if start > 0 else 0
+		for y in range(start, self.height):
+			acc |= rows[y]
+			solid[y] = acc
 
 	def row_full(self, row):
-		for col in range(len(self.columns)):
-			if self.tiles[(col,row)] == Color.CLEAR:
-				return False
-		return True
+		return 0 <= row < self.height and self.row_counts[row] == self.width
+
+	def get_tile_color(self, x, y):
+		return Color(self.colors[y][x])
 
 	def set_tile_color(self, x, y, color):
 		assert color != Color.CLEAR
-		self.tiles[(x,y)] = color
-		if self.columns[x] > y:
+		if not 0 <= x < self.width:
+			return
+		self.revision += 1
+		top = self.columns[x]
+		if 0 <= y < self.height:
+			bit = 1 << x
+			if not self.rows[y] & bit:
+				self.rows[y] |= bit
+				self.row_counts[y] += 1
+				self.zobrist ^= self.zobrist_table[y][x]
+			self.colors[y] = _replace(self.colors[y], x, color)
+			for y_solid in range(y, top):
+				self.solid[y_solid] |= bit
+			for v in self.views:
+				v.tile_changed(x, y, color)
+		if top > y:
 			self.columns[x] = y
+		if self.views and self.piece is not None:
+			self._piece_changed()
 
 	def piece_can_move(self, x_move, y_move):
 		"""Returns True if a piece can move, False otherwise."""
-		for base_x, base_y in self.piece:
-			x = x_move + base_x
-			y = y_move + base_y
-			if not 0 <= x < len(self.columns) or y >= self.columns[x]:
+		p = self.piece
+		return self.piece_fits(p.shape, p.x + x_move, p.y + y_move, p.rotation)
+
+	def piece_fits(self, shape, x, y, rotation):
+		"""Returns True if shape fits at (x, y) in the given rotation."""
+		left, right, masks = shape["masks"][rotation]
+		x += left
+		if x < 0 or x + right - left >= self.width:
+			return False
+		height = self.height
+		solid = self.solid
+		for dy, mask in masks:
+			row = y + dy
+			if row >= height or (row >= 0 and solid[row] & (mask << x)):
 				return False
 		return True
 
@@ -207,15 +684,79 @@ class Board:
 		else:
 			self.piece.move(0, 1)
 			self.finalize_ready = False
+			self.revision += 1
+			if self.views:
+				self._piece_changed()
 
 	def full_drop_piece(self):
 		"""Either drops a piece down one level, or finalizes it and creates another piece."""
 		if self.piece is None:
 			return
-		while self.piece_can_move(0, 1):
-			self.piece.move(0, 1)
+		self.piece.y = self.landing_row(self.piece)
 		self.finalize_piece()
-		self.generate_piece()
+		if self.autogen:
+			self.generate_piece()
+
+	def landing_row(self, piece):
+		"""Returns the y a piece would come to rest at if dropped straight down."""
+		x = piece.x
+		columns = self.columns
+		return min(columns[x + dx] - dy - 1
+		           for dx, dy in piece.shape["profiles"][piece.rotation])
+
+	def legal_placements(self, piece=None):
+		"""Returns every distinct position a piece (the current one by
+		default) can come to rest in, as a sorted list of (x, rotation, y).
+
+		Positions are those reachable with move_piece() and rotate_piece().
+		A piece that fits somewhere also fits anywhere above it, since it
+		collides with whole columns, so any move possible lower down is
+		possible at the starting height too. The search is therefore over
+		(x, rotation) at the starting y, each dropping to its landing row.
+		Rotations of a symmetric shape that cover the same tiles count once.
+		"""
+		if piece is None:
+			piece = self.piece
+		shape = piece.shape
+		masks = shape["masks"]
+		profiles = shape["profiles"]
+		symmetry = shape["symmetry"]
+		width = self.width
+		height = self.height
+		solid = self.solid
+		columns = self.columns
+		y = piece.y
+
+		def fits(x, rotation):
+			# piece_fits(), inlined for speed
+			left, right, rows = masks[rotation]
+			x += left
+			if x < 0 or x + right - left >= width:
+				return False
+			for dy, mask in rows:
+				row = y + dy
+				if row >= height or (row >= 0 and solid[row] & (mask << x)):
+					return False
+			return True
+
+		start = (piece.x, piece.rotation)
+		if not fits(*start):
+			return []
+
+		seen = {start}
+		queue = [start]
+		placements = {}
+		for x, rotation in queue:
+			landing = min(columns[x + dx] - dy - 1 for dx, dy in profiles[rotation])
+			r, dx, dy = symmetry[rotation]
+			placements.setdefault((x + dx, r, landing + dy), (x, rotation, landing))
+			for state in ((x - 1, rotation), (x + 1, rotation),
+			              (x, (rotation + 1) % 4), (x, (rotation - 1) % 4)):
+				if state not in seen:
+					seen.add(state)
+					if fits(*state):
+						queue.append(state)
+		return sorted(placements.values())
 
 	def move_piece(self, x_move, y_move):
 		"""Move a piece some number of spaces in any direction"""
@@ -223,29 +764,40 @@ class Board:
 			return
 		if self.piece_can_move(x_move, y_move):
 			self.piece.move(x_move, y_move)
+			self.revision += 1
+			if self.views:
+				self._piece_changed()
 
 	def rotate_piece(self, clockwise=True):
 		if self.piece is None:
 			return
 		if self.piece_can_rotate(clockwise):
 			self.piece.rotate(clockwise)
+			self.revision += 1
+			if self.views:
+				self._piece_changed()
 
 	def piece_can_rotate(self, clockwise):
-		"""Returns True if a piece can drop, False otherwise."""
-		p = self.piece.rotated(clockwise)
-		for x, y in p:
-			if not 0 <= x < len(self.columns) or y >= self.columns[x]:
-				return False
-		return True
-
-	def generate_piece(self):
-		"""Creates a new piece at random and places it at the top of the board."""
+		"""Returns True if a piece can rotate, False otherwise."""
+		p = self.piece
+		rotation = (p.rotation + (1 if clockwise else -1)) % 4
+		return self.piece_fits(p.shape, p.x, p.y, rotation)
+
+	def generate_piece(self, shape=None):
+		"""Creates a new piece at random (or of the given shape) and places it
+		at the top of the board."""
 		if self.game_over:
 			return
 
-		middle = len(self.columns) // 2
-		shape = self.rand.choice(Piece.SHAPES)
+		middle = self.width // 2
+		if shape is None:
+			if self.queue:
+				shape = self.queue.pop(0)
+			else:
+				shape = self.rand.choice(Piece.SHAPES)
+				self._rand_state = None
 		self.piece = Piece(middle - shape["x_adj"], 0, shape, shape["color"])
+		self.revision += 1
 
 		if not self.piece_can_move(0, 0):
 			# Show piece on the board
@@ -254,29 +806,88 @@ class Board:
 			# And mark the game as over
 			self.game_over = True
 			self.piece = None
+		elif self.views:
+			self._piece_changed()
+
+	def preview(self, n):
+		"""Returns the shapes of the next n randomly generated pieces."""
+		while len(self.queue) < n:
+			self.queue.append(self.rand.choice(Piece.SHAPES))
+			self._rand_state = None
+		return self.queue[:n]
 
 	def finalize_piece(self):
 		for x, y in self.piece:
 			self.set_tile_color(x, y, self.piece.color)
 
-		rows_cleared = 0
-		for y in range(0, self.height + 1):
-			if self.row_full(y):
-				self.clear_row(y)
-				rows_cleared += 1
+		# Only rows the piece landed in can have become full
+		full = [y for y in set(y for x, y in self.piece) if self.row_full(y)]
+		if full:
+			self.clear_rows(full)
+		rows_cleared = len(full)
 
 		self.score += (rows_cleared * rows_cleared) * 10
 		self.lines += rows_cleared
 		self.level = self.lines // 10 + 1
 
 		self.piece = None
+		self.revision += 1
+		if self.views:
+			self._piece_changed()
+			if rows_cleared:
+				for v in self.views:
+					v.set_score(self.score)
+					v.set_level(self.level)
+
+	def snapshot(self):
+		"""Returns the board's state as an immutable BoardState. Rows are
+		shared with the board rather than copied, and so is the random
+		generator's state until the board draws another piece; drawing from
+		self.rand directly between snapshots isn't noticed."""
+		if self._rand_state is None:
+			self._rand_state = self.rand.getstate()
+		p = self.piece
+		if p is not None:
+			p = (p.x, p.y, p.shape, p.color, p.rotation)
+		return BoardState(tuple(self.rows), tuple(self.solid),
+		                  tuple(self.row_counts), tuple(self.colors),
+		                  tuple(self.columns), self.zobrist, p,
+		                  tuple(self.queue), self.finalize_ready,
+		                  self.score, self.level, self.lines, self.game_over,
+		                  self._rand_state)
+
+	def restore(self, state):
+		"""Puts the board back into a state returned by snapshot()."""
+		self.rows = list(state.rows)
+		self.solid = list(state.solid)
+		self.row_counts = list(state.row_counts)
+		self.colors = list(state.colors)
+		self.columns = list(state.columns)
+		self.zobrist = state.zobrist
+		self.piece = None if state.piece is None else Piece(*state.piece)
+		self.queue = list(state.queue)
+		self.finalize_ready = state.finalize_ready
+		self.score = state.score
+		self.level = state.level
+		self.lines = state.lines
+		self.game_over = state.game_over
+		if state.rand is not self._rand_state:
+			self.rand.setstate(state.rand)
+			self._rand_state = state.rand
+		self.revision += 1
+		self._redraw()
 
 	def render(self, v):
-		v.clear()
-		v.set_size(len(self.columns), self.height)
-		for (x,y), color in self.tiles.items():
-			v.render_tile(x, y, color)
+		"""Redraws everything on a view."""
+		# set_size() clears the view
+		v.set_size(self.width, self.height)
+		for y, mask in enumerate(self.rows):
+			if mask:
+				v.render_row(y, self.colors[y])
 		if self.piece is not None:
-			self.piece.render(v)
+			ghost_y = self.landing_row(self.piece) - self.piece.y
+			for x, y in self.piece:
+				v.render_ghost(x, y + ghost_y, self.piece.color)
+			v.render_piece(self.piece)
 		v.set_score(self.score)
 		v.set_level(self.level)
@@ -0,0 +1,231 @@
+"""A vectorized, Gym-style environment over engine.Board.
+
+VecEnv steps N boards at once. Actions are replay opcodes (DROP is a
+gravity tick, FULL_DROP a hard drop). Observations are written into
+preallocated NumPy arrays and the same arrays are returned every step,
+so copy them if they need to outlive the next step:
+
+	grid     (N, height, width) uint8, 1 where a tile is filled
+	piece    (N, 4) int16: shape index + 1 (0 for none), rotation, x, y
+	columns  (N, width) int16 column heights
+	reward   (N,) float32 score gained by the step
+	done     (N,) bool, the game ended (the board has been reset)
+
+With processes > 1 the boards are split between worker processes that
+write straight into the arrays, which live in shared memory.
+"""
+import os
+from multiprocessing import Pipe, Process
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from engine import Board, Piece
+import replay
+
+# Actions
+NOOP = replay.DROP
+LEFT = replay.LEFT
+RIGHT = replay.RIGHT
+ROTATE_CW = replay.ROTATE_CW
+ROTATE_CCW = replay.ROTATE_CCW
+DOWN = replay.DOWN
+FULL_DROP = replay.FULL_DROP
+N_ACTIONS = 7
+
+
+def _layout(n, width, height):
+	"""Returns [(name, dtype, shape)] for every array in the buffer."""
+	return [("grid", np.uint8, (n, height, width)),
+	        ("piece", np.int16, (n, 4)),
+	        ("columns", np.int16, (n, width)),
+	        ("reward", np.float32, (n,)),
+	        ("done", np.bool_, (n,)),
+	        ("action", np.int8, (n,))]
+
+def _buffer_size(n, width, height):
+	size = 0
+	for name, dtype, shape in _layout(n, width, height):
+		# Keep every array 8 byte aligned
+		size += -(-np.dtype(dtype).itemsize * int(np.prod(shape)) // 8) * 8
+	return size
+
+def _arrays(buf, n, width, height):
+	"""Returns {name: array} viewing consecutive parts of buf. The arrays
+	hold buf's buffer, so it can't be unmapped while they're alive."""
+	arrays = {}
+	offset = 0
+	for name, dtype, shape in _layout(n, width, height):
+		count = int(np.prod(shape))
+		arrays[name] = np.frombuffer(buf, dtype, count, offset).reshape(shape)
+		offset += -(-np.dtype(dtype).itemsize * count // 8) * 8
+	return arrays
+
+
+class _SharedMemory(SharedMemory):
+	"""SharedMemory that can be closed while arrays returned to the caller
+	still view it; the mapping is then released with the last of them."""
+
+	def close(self):
+		try:
+			SharedMemory.close(self)
+		except BufferError:
+			self._mmap = None
+			if self._fd >= 0:
+				os.close(self._fd)
+				self._fd = -1
+
+
+class _Boards:
+	"""Boards start..stop of an environment, writing their observations
+	into the shared arrays."""
+
+	def __init__(self, arrays, start, stop, width, height):
+		self.start = start
+		self.stop = stop
+		self.boards = [Board(width, height) for i in range(start, stop)]
+		self.width = width
+		self.height = height
+		# Views of this slice of each array
+		self.arrays = {name : a[start:stop] for name, a in arrays.items()}
+		self.shape_ids = {id(shape) : i + 1 for i, shape in enumerate(Piece.SHAPES)}
+		# Row masks of every board, unpacked into the grid in one go
+		self.masks = np.zeros((stop - start, height), dtype="<u8")
+
+	def reset(self, seeds=None):
+		for i, b in enumerate(self.boards):
+			if seeds is not None:
+				b.rand.seed(seeds[i])
+			b.reset()
+			b.generate_piece()
+		self.arrays["reward"][:] = 0
+		self.arrays["done"][:] = False
+		self.observe()
+
+	def step(self):
+		reward = self.arrays["reward"]
+		done = self.arrays["done"]
+		apply = replay.apply
+		for i, (b, action) in enumerate(zip(self.boards, self.arrays["action"].tolist())):
+			score = b.score
+			apply(b, action)
+			reward[i] = b.score - score
+			done[i] = b.game_over
+			if b.game_over:
+				b.reset()
+				b.generate_piece()
+		self.observe()
+
+	def observe(self):
+		a = self.arrays
+		shape_ids = self.shape_ids
+		pieces = []
+		for b in self.boards:
+			p = b.piece
+			if p is None:
+				pieces.append((0, 0, 0, 0))
+			else:
+				pieces.append((shape_ids[id(p.shape)], p.rotation, p.x, p.y))
+		a["piece"][:] = pieces
+		a["columns"][:] = [b.columns for b in self.boards]
+		np.subtract(self.height, a["columns"], out=a["columns"])
+		self.masks[:] = [b.rows for b in self.boards]
+		bits = np.unpackbits(self.masks.view(np.uint8), axis=-1, bitorder="little")
+		a["grid"][:] = bits.reshape(len(self.boards), self.height, 64)[:, :, :self.width]
+
+
+def _worker(conn, shm_name, n, width, height, start, stop):
+	shm = SharedMemory(shm_name)
+	try:
+		boards = _Boards(_arrays(shm.buf, n, width, height), start, stop, width, height)
+		while True:
+			command, arg = conn.recv()
+			if command == "step":
+				boards.step()
+			elif command == "reset":
+				boards.reset(arg)
+			else:
+				break
+			conn.send(None)
+	finally:
+		# The views must go before the memory can be closed
+		boards = None
+		shm.close()
+
+
+class VecEnv:
+	def __init__(self, n, width=10, height=20, processes=1):
+		if width > 64:
+			raise ValueError("boards wider than 64 columns aren't supported")
+		self.n = n
+		self.width = width
+		self.height = height
+		self.shm = None
+		self.workers = []
+		if processes > 1:
+			self.shm = _SharedMemory(create=True, size=_buffer_size(n, width, height))
+			buf = self.shm.buf
+		else:
+			buf = bytearray(_buffer_size(n, width, height))
+		self.arrays = _arrays(buf, n, width, height)
+		self.obs = {name : self.arrays[name] for name in ("grid", "piece", "columns")}
+
+		if processes > 1:
+			bounds = np.linspace(0, n, processes + 1).astype(int)
+			for start, stop in zip(bounds, bounds[1:]):
+				parent, child = Pipe()
+				p = Process(target=_worker, daemon=True,
+				            args=(child, self.shm.name, n, width, height, start, stop))
+				p.start()
+				self.workers.append((p, parent))
+			self.local = None
+		else:
+			self.local = _Boards(self.arrays, 0, n, width, height)
+
+	def _call(self, command, per_worker=None):
+		for i, (p, conn) in enumerate(self.workers):
+			conn.send((command, per_worker[i] if per_worker else None))
+		for p, conn in self.workers:
+			conn.recv()
+
+	def reset(self, seeds=None):
+		"""Starts new games, seeding board i's pieces with seeds[i] if
+		given. Returns the observations."""
+		if self.local is not None:
+			self.local.reset(seeds)
+		else:
+			per_worker = None
+			if seeds is not None:
+				bounds = np.linspace(0, self.n, len(self.workers) + 1).astype(int)
+				per_worker = [list(seeds[start:stop])
+				              for start, stop in zip(bounds, bounds[1:])]
+			self._call("reset", per_worker)
+		return self.obs
+
+	def step(self, actions):
+		"""Applies one action per board, returning (observations, reward,
+		done). Finished games are reset straight away."""
+		self.arrays["action"][:] = actions
+		if self.local is not None:
+			self.local.step()
+		else:
+			self._call("step")
+		return self.obs, self.arrays["reward"], self.arrays["done"]
+
+	def close(self):
+		for p, conn in self.workers:
+			conn.send(("close", None))
+			p.join()
+		self.workers = []
+		if self.shm is not None:
+			# Observations already returned stay readable, see _SharedMemory
+			self.arrays = self.obs = None
+			self.shm.unlink()
+			self.shm.close()
+			self.shm = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
@@ -0,0 +1,82 @@
+"""Per-frame phase timing.
+
+FrameTimer times named phases of each frame, keeps a rolling window of
+recent timings for percentiles, and records Chrome trace events that can
+be loaded in chrome://tracing or Perfetto.
+"""
+import json
+import os
+import time
+from collections import deque
+
+
+class _Phase:
+	__slots__ = ("timer", "name", "start")
+
+	def __init__(self, timer, name):
+		self.timer = timer
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+
+	def __exit__(self, *exc):
+		self.timer.add(self.name, self.start, time.perf_counter())
+
+
+class FrameTimer:
+	def __init__(self, window=300, max_events=200000):
+		self.window = window
+		self.samples = {}
+		self.order = []
+		self.events = deque(maxlen=max_events)
+		self.frame_start = None
+		self.epoch = time.perf_counter()
+
+	def phase(self, name):
+		"""Returns a context manager that times one phase of the frame."""
+		return _Phase(self, name)
+
+	def add(self, name, start, end):
+		if name not in self.samples:
+			self.samples[name] = deque(maxlen=self.window)
+			self.order.append(name)
+		self.samples[name].append(end - start)
+		self.events.append((name, start, end))
+
+	def begin_frame(self):
+		self.frame_start = time.perf_counter()
+
+	def end_frame(self):
+		if self.frame_start is not None:
+			self.add("frame", self.frame_start, time.perf_counter())
+			self.frame_start = None
+
+	def percentiles(self, name, points=(50, 95, 99)):
+		"""Returns the given percentiles, in seconds, of a phase's recent timings."""
+		samples = sorted(self.samples.get(name, ()))
+		if not samples:
+			return tuple(0.0 for p in points)
+		last = len(samples) - 1
+		return tuple(samples[min(last, int(round(p / 100 * last)))] for p in points)
+
+	def summary(self):
+		"""Returns lines of p50/p95/p99 milliseconds for every phase."""
+		lines = ["{:<8} {:>8} {:>8} {:>8}".format("ms", "p50", "p95", "p99")]
+		for name in self.order:
+			lines.append("{:<8} {:>8.2f} {:>8.2f} {:>8.2f}".format(
+				name, *(p * 1000 for p in self.percentiles(name))))
+		return lines
+
+	def trace_events(self):
+		"""Returns the recorded phases as Chrome trace "complete" events."""
+		pid = os.getpid()
+		return [{"name" : name, "ph" : "X", "pid" : pid, "tid" : 0,
+		         "ts" : (start - self.epoch) * 1e6,
+		         "dur" : (end - start) * 1e6}
+		        for name, start, end in self.events]
+
+	def dump_trace(self, path):
+		with open(path, "w") as f:
+			json.dump({"traceEvents" : self.trace_events(),
+			           "displayTimeUnit" : "ms"}, f)
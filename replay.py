@@ -0,0 +1,282 @@
+"""Compact binary replays of Board sessions.
+
+A replay is a header followed by one varint per input: the ticks (ms)
+since the previous input shifted left 3 bits, or'd with a 3 bit opcode.
+Every `keyframe_every` inputs a KEYFRAME record holds the full board
+state, so a player can seek without replaying from the start.
+
+Run `python -m replay FILE` to replay a file headlessly.
+"""
+import argparse
+import struct
+import time
+from bisect import bisect_right
+
+from engine import Board, Color, Piece, TextView
+
+MAGIC = b"TRPL"
+# Bumped whenever the header or keyframe layout changes. Version 2 added
+# the preview queue to keyframes.
+VERSION = 2
+
+# Opcodes
+DROP = 0
+LEFT = 1
+RIGHT = 2
+ROTATE_CW = 3
+ROTATE_CCW = 4
+DOWN = 5
+FULL_DROP = 6
+KEYFRAME = 7
+
+# Mersenne Twister state: 624 words plus the position in them
+_RAND_STATE = "<625I"
+
+
+def apply(board, op):
+	"""Performs one input on a board."""
+	if op == DROP:
+		board.drop_piece()
+	elif op == LEFT:
+		board.move_piece(-1, 0)
+	elif op == RIGHT:
+		board.move_piece(1, 0)
+	elif op == ROTATE_CW:
+		board.rotate_piece()
+	elif op == ROTATE_CCW:
+		board.rotate_piece(clockwise=False)
+	elif op == DOWN:
+		board.move_piece(0, 1)
+	elif op == FULL_DROP:
+		board.full_drop_piece()
+	else:
+		raise ValueError("bad replay opcode {}".format(op))
+
+
+def write_varint(buf, n):
+	while n > 0x7f:
+		buf.append((n & 0x7f) | 0x80)
+		n >>= 7
+	buf.append(n)
+
+def read_varint(data, pos):
+	"""Returns (value, new position)."""
+	n = 0
+	shift = 0
+	while True:
+		byte = data[pos]
+		pos += 1
+		n |= (byte & 0x7f) << shift
+		if byte < 0x80:
+			return n, pos
+		shift += 7
+
+def zigzag(n):
+	return (n << 1) ^ (n >> 63) if n < 0 else n << 1
+
+def unzigzag(n):
+	return (n >> 1) ^ -(n & 1)
+
+
+def encode_board(b):
+	"""Packs all of a board's state, including its random generator."""
+	buf = bytearray()
+	for mask in b.rows:
+		write_varint(buf, mask)
+	for y, mask in enumerate(b.rows):
+		colors = b.colors[y]
+		for x in range(b.width):
+			if mask >> x & 1:
+				buf.append(colors[x])
+	for n in (b.score, b.lines, b.level, b.finalize_ready, b.game_over):
+		write_varint(buf, n)
+	p = b.piece
+	if p is None:
+		buf.append(0)
+	else:
+		buf.append(1 + Piece.SHAPES.index(p.shape))
+		for n in (zigzag(p.x), zigzag(p.y), p.rotation, p.color):
+			write_varint(buf, n)
+	buf.append(len(b.queue))
+	for shape in b.queue:
+		buf.append(Piece.SHAPES.index(shape))
+	version, state, gauss = b.rand.getstate()
+	buf += struct.pack(_RAND_STATE, *state)
+	return bytes(buf)
+
+def decode_board(b, data, pos=0):
+	"""Restores a board from encode_board() output, returning the position
+	after it."""
+	b.reset()
+	masks = []
+	for y in range(b.height):
+		mask, pos = read_varint(data, pos)
+		masks.append(mask)
+	for y, mask in enumerate(masks):
+		for x in range(b.width):
+			if mask >> x & 1:
+				b.set_tile_color(x, y, Color(data[pos]))
+				pos += 1
+	b.score, pos = read_varint(data, pos)
+	b.lines, pos = read_varint(data, pos)
+	b.level, pos = read_varint(data, pos)
+	ready, pos = read_varint(data, pos)
+	game_over, pos = read_varint(data, pos)
+	b.finalize_ready = bool(ready)
+	b.game_over = bool(game_over)
+	shape = data[pos]
+	pos += 1
+	if shape:
+		x, pos = read_varint(data, pos)
+		y, pos = read_varint(data, pos)
+		rotation, pos = read_varint(data, pos)
+		color, pos = read_varint(data, pos)
+		b.piece = Piece(unzigzag(x), unzigzag(y), Piece.SHAPES[shape - 1],
+		                Color(color), rotation)
+	n = data[pos]
+	b.queue = [Piece.SHAPES[i] for i in data[pos + 1:pos + 1 + n]]
+	pos += 1 + n
+	state = struct.unpack_from(_RAND_STATE, data, pos)
+	b.rand.setstate((3, state, None))
+	return pos + struct.calcsize(_RAND_STATE)
+
+
+class ReplayRecorder:
+	"""Records the inputs applied to a freshly seeded board.
+
+	The board must have been created with an integer seed and had its first
+	piece generated, and nothing else done to it."""
+
+	def __init__(self, board, keyframe_every=1024):
+		self.board = board
+		self.keyframe_every = keyframe_every
+		self.buf = bytearray(MAGIC)
+		self.buf.append(VERSION)
+		for n in (board.width, board.height, board.seed, keyframe_every):
+			write_varint(self.buf, n)
+		self.count = 0
+		self.last_tick = 0
+
+	def record(self, op, tick):
+		"""Records an input at time tick (ms), before it is applied."""
+		delta = max(0, tick - self.last_tick)
+		self.last_tick = tick
+		if self.count and self.count % self.keyframe_every == 0:
+			frame = encode_board(self.board)
+			write_varint(self.buf, KEYFRAME)
+			write_varint(self.buf, len(frame))
+			self.buf += frame
+		write_varint(self.buf, (delta << 3) | op)
+		self.count += 1
+
+	def apply(self, op, tick):
+		"""Records an input and applies it to the board."""
+		self.record(op, tick)
+		apply(self.board, op)
+
+	def getvalue(self):
+		return bytes(self.buf)
+
+	def save(self, path):
+		with open(path, "wb") as f:
+			f.write(self.buf)
+
+
+class ReplayPlayer:
+	"""Re-executes a replay on a headless board."""
+
+	def __init__(self, data):
+		if data[:4] != MAGIC or data[4] != VERSION:
+			raise ValueError("not a version {} replay".format(VERSION))
+		pos = 5
+		self.width, pos = read_varint(data, pos)
+		self.height, pos = read_varint(data, pos)
+		self.seed, pos = read_varint(data, pos)
+		self.keyframe_every, pos = read_varint(data, pos)
+
+		# Split the stream into (ticks, ops) and index the keyframes
+		self.data = data
+		self.ticks = []
+		self.ops = []
+		self.keyframes = []
+		tick = 0
+		ops = self.ops
+		ticks = self.ticks
+		n = len(data)
+		while pos < n:
+			value, pos = read_varint(data, pos)
+			op = value & 7
+			if op == KEYFRAME:
+				length, pos = read_varint(data, pos)
+				self.keyframes.append((len(ops), pos))
+				pos += length
+				continue
+			tick += value >> 3
+			ticks.append(tick)
+			ops.append(op)
+
+	@classmethod
+	def load(cls, path):
+		with open(path, "rb") as f:
+			return cls(f.read())
+
+	def __len__(self):
+		return len(self.ops)
+
+	def new_board(self):
+		b = Board(self.width, self.height, seed=self.seed)
+		b.generate_piece()
+		return b
+
+	def play(self, board=None, start=0, stop=None):
+		"""Applies inputs start..stop to a board (a new one by default)
+		and returns it."""
+		if board is None:
+			board = self.new_board()
+		for op in self.ops[start:stop]:
+			apply(board, op)
+		return board
+
+	def seek(self, index):
+		"""Returns a board in the state just before input index."""
+		start = 0
+		b = self.new_board()
+		for frame_index, pos in self.keyframes:
+			if frame_index > index:
+				break
+			start = frame_index
+			frame_pos = pos
+		if start:
+			decode_board(b, self.data, frame_pos)
+		return self.play(b, start, index)
+
+	def seek_tick(self, tick):
+		"""Returns a board in the state at time tick (ms)."""
+		return self.seek(bisect_right(self.ticks, tick))
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Replay a recorded game headlessly.")
+	parser.add_argument("path")
+	parser.add_argument("--seek", type=int, default=None,
+	                    help="show the board just before this input")
+	args = parser.parse_args(argv)
+
+	start = time.perf_counter()
+	player = ReplayPlayer.load(args.path)
+	if args.seek is None:
+		b = player.play()
+	else:
+		b = player.seek(args.seek)
+	elapsed = time.perf_counter() - start
+
+	v = TextView()
+	b.render(v)
+	v.show()
+	print("{} inputs over {:.0f}s of play, replayed in {:.3f}s".format(
+		len(player), (player.ticks[-1] if player.ticks else 0) / 1000, elapsed))
+	print("score {} lines {} level {}".format(b.score, b.lines, b.level))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,304 @@
+"""Searching over board positions, and a beam search autoplayer.
+
+BeamSearch looks ahead over the current piece and the preview queue,
+keeping the best few boards at each ply by a weighted sum of classic
+features. Boards travel to worker processes as tuples of row masks.
+"""
+from collections import OrderedDict
+from multiprocessing import Pool, TimeoutError
+import time
+
+from engine import Board, Piece
+import replay
+
+# Feature weights from Yiyuan Lee's "Tetris AI - The (Near) Perfect Bot"
+WEIGHTS = {
+	"height" : -0.510066,
+	"lines" : 0.760666,
+	"holes" : -0.35663,
+	"bumpiness" : -0.184483,
+}
+
+
+class TranspositionCache:
+	"""Caches values, such as evaluations, by board key (Board.state_key()
+	or Board.zobrist), holding at most max_entries and evicting the least
+	recently used."""
+
+	def __init__(self, max_entries=100000):
+		self.max_entries = max_entries
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def get(self, key, default=None):
+		entries = self.entries
+		try:
+			value = entries[key]
+		except KeyError:
+			self.misses += 1
+			return default
+		entries.move_to_end(key)
+		self.hits += 1
+		return value
+
+	def put(self, key, value):
+		entries = self.entries
+		entries[key] = value
+		entries.move_to_end(key)
+		if len(entries) > self.max_entries:
+			entries.popitem(last=False)
+			self.evictions += 1
+
+	def clear(self):
+		self.entries.clear()
+
+	def stats(self):
+		"""Returns the counters as a dict, with the hit rate."""
+		lookups = self.hits + self.misses
+		return {"entries" : len(self.entries),
+		        "hits" : self.hits,
+		        "misses" : self.misses,
+		        "evictions" : self.evictions,
+		        "hit_rate" : self.hits / lookups if lookups else 0.0}
+
+
+def features(board):
+	"""Returns (aggregate height, holes, bumpiness) of a board."""
+	height = board.height
+	heights = [height - top for top in board.columns]
+	aggregate = sum(heights)
+	# Everything under a column's top that isn't filled is a hole
+	holes = aggregate - sum(board.row_counts)
+	bumpiness = sum(abs(a - b) for a, b in zip(heights, heights[1:]))
+	return aggregate, holes, bumpiness
+
+def evaluate(board, lines, weights=WEIGHTS):
+	"""Scores a board that was reached by clearing the given lines."""
+	aggregate, holes, bumpiness = features(board)
+	return (weights["height"] * aggregate + weights["lines"] * lines
+	        + weights["holes"] * holes + weights["bumpiness"] * bumpiness)
+
+
+# One board per size for each process to expand nodes on
+_scratch = {}
+
+def _expand(task):
+	"""Places a piece in every legal position on a board given as row masks.
+
+	task is (width, height, rows, shape index, start, weights), start being
+	the piece's (x, y, rotation) or None for the spawn position. Returns
+	[(value, lines, zobrist, rows, (x, rotation)), ...], value being the
+	board's evaluation without the lines term."""
+	width, height, rows, shape_index, start, weights = task
+	b = _scratch.get((width, height))
+	if b is None:
+		b = _scratch[width, height] = Board(width, height, autogen=False)
+	b.game_over = False
+	b.score = b.lines = 0
+	b.load_rows(rows)
+	shape = Piece.SHAPES[shape_index]
+	if start is None:
+		start = (width // 2 - shape["x_adj"], 0, 0)
+	x, y, rotation = start
+	piece = Piece(x, y, shape, shape["color"], rotation)
+	if not b.piece_fits(shape, x, y, rotation):
+		return []
+
+	state = b.snapshot()
+	no_lines = dict(weights, lines=0)
+	children = []
+	for x, rotation, y in b.legal_placements(piece):
+		b.restore(state)
+		b.piece = Piece(x, y, shape, shape["color"], rotation)
+		b.finalize_piece()
+		children.append((evaluate(b, 0, no_lines), b.lines, b.zobrist,
+		                 tuple(b.rows), (x, rotation)))
+	return children
+
+
+class BeamSearch:
+	"""Picks placements by beam search over the current piece and the next
+	depth - 1 pieces of the preview queue.
+
+	Each ply expands the beam_width best boards of the last one. With
+	processes > 1 the expansions run on a process pool. With a time budget
+	(seconds per move) the search stops at the last ply it finished in
+	time; the first ply always finishes."""
+
+	def __init__(self, beam_width=8, depth=3, weights=WEIGHTS, processes=1,
+	             time_budget=None, cache_size=20000):
+		self.beam_width = beam_width
+		self.depth = depth
+		self.weights = weights
+		self.time_budget = time_budget
+		self.processes = processes
+		self.pool = Pool(processes) if processes > 1 else None
+		# Expansions from the spawn position, by (zobrist, shape index)
+		self.cache = TranspositionCache(cache_size)
+		# (AsyncResult, cache key or None) of expansions still running when
+		# a search ran out of time
+		self.abandoned = []
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool = None
+		self.abandoned = []
+
+	def _collect_abandoned(self):
+		"""Caches abandoned expansions that have finished since, and returns
+		how many are still running."""
+		running = []
+		for result, key in self.abandoned:
+			if not result.ready():
+				running.append((result, key))
+			elif key is not None and result.successful():
+				self.cache.put(key, result.get())
+		self.abandoned = running
+		return len(running)
+
+	def _expand_pool(self, tasks, keys, deadline):
+		"""Runs tasks on the pool, no more at once than there are workers, so
+		nothing is queued that the deadline would leave behind. Returns
+		{task index: children}, or None if out of time."""
+		expanded = {}
+		running = {}
+		queue = list(enumerate(tasks))
+		while queue or running:
+			if deadline is not None and time.perf_counter() > deadline:
+				break
+			busy = self._collect_abandoned()
+			while queue and len(running) + busy < self.processes:
+				i, task = queue.pop(0)
+				running[i] = self.pool.apply_async(_expand, (task,))
+			if not running:
+				# Only abandoned work is running; wait for a worker to free up
+				time.sleep(0.0005)
+				continue
+			i = next(iter(running))
+			try:
+				expanded[i] = running[i].get(None if deadline is None
+				                             else max(0, deadline - time.perf_counter()))
+			except TimeoutError:
+				break
+			del running[i]
+		else:
+			return expanded
+		self.abandoned.extend((result, keys[i]) for i, result in running.items())
+		return None
+
+	def _expand_all(self, board, nodes, shape_index, start, deadline):
+		"""Returns the children of each node, or None if out of time."""
+		results = [None] * len(nodes)
+		tasks = []
+		for i, (value, lines, zobrist, rows, first) in enumerate(nodes):
+			if start is None:
+				results[i] = self.cache.get((zobrist, shape_index))
+			if results[i] is None:
+				tasks.append((i, (board.width, board.height, rows, shape_index,
+				                  start, self.weights)))
+
+		if self.pool is not None and len(tasks) > 1:
+			keys = [(nodes[i][2], shape_index) if start is None else None
+			        for i, task in tasks]
+			done = self._expand_pool([task for i, task in tasks], keys, deadline)
+			if done is None:
+				return None
+			expanded = [done[j] for j in range(len(tasks))]
+		else:
+			expanded = []
+			for i, task in tasks:
+				if deadline is not None and time.perf_counter() > deadline:
+					return None
+				expanded.append(_expand(task))
+
+		for (i, task), children in zip(tasks, expanded):
+			results[i] = children
+			if start is None:
+				self.cache.put((nodes[i][2], shape_index), children)
+		return results
+
+	def best_move(self, board, time_budget=None):
+		"""Returns the (x, rotation) to place board.piece at, or None if it
+		has nowhere to go."""
+		if board.piece is None:
+			return None
+		start_time = time.perf_counter()
+		if time_budget is None:
+			time_budget = self.time_budget
+		deadline = None if time_budget is None else start_time + time_budget
+
+		w_lines = self.weights["lines"]
+		p = board.piece
+		shapes = [Piece.SHAPES.index(p.shape)]
+		shapes += [Piece.SHAPES.index(s) for s in board.preview(self.depth - 1)]
+		beam = [(0.0, 0, board.zobrist, tuple(board.rows), None)]
+		best = None
+		for ply, shape_index in enumerate(shapes):
+			start = (p.x, p.y, p.rotation) if ply == 0 else None
+			expanded = self._expand_all(board, beam, shape_index, start,
+			                            deadline if ply else None)
+			if expanded is None:
+				break
+			# Keep the best way of reaching each board
+			children = {}
+			for (value, lines, zobrist, rows, first), nodes in zip(beam, expanded):
+				for c_value, c_lines, c_zobrist, c_rows, placement in nodes:
+					total = lines + c_lines
+					score = c_value + w_lines * total
+					if c_zobrist not in children or score > children[c_zobrist][0]:
+						children[c_zobrist] = (score, total, c_zobrist, c_rows,
+						                       first or placement)
+			if not children:
+				break
+			beam = sorted(children.values(), key=lambda node: node[0],
+			              reverse=True)[:self.beam_width]
+			best = beam[0][4]
+		return best
+
+	def position(self, board, time_budget=None):
+		"""Shifts and rotates board.piece to the best placement, ready to be
+		dropped."""
+		move = self.best_move(board, time_budget)
+		if move is not None:
+			for op in moves_to(board, *move):
+				replay.apply(board, op)
+
+
+def moves_to(board, x, rotation):
+	"""Returns the replay opcodes that shift and rotate board.piece to x and
+	rotation at its current height, or None if it can't get there."""
+	p = board.piece
+	fits = board.piece_fits
+	start = (p.x, p.rotation)
+	paths = {start : []}
+	queue = [start]
+	for state in queue:
+		if state == (x, rotation):
+			return paths[state]
+		px, rot = state
+		for op, nxt in ((replay.LEFT, (px - 1, rot)), (replay.RIGHT, (px + 1, rot)),
+		                (replay.ROTATE_CW, (px, (rot + 1) % 4)),
+		                (replay.ROTATE_CCW, (px, (rot - 1) % 4))):
+			if nxt not in paths and fits(p.shape, nxt[0], p.y, nxt[1]):
+				paths[nxt] = paths[state] + [op]
+				queue.append(nxt)
+	return None
+
+
+_policy_search = None
+
+def beam_policy(board, rand):
+	"""A sim policy that positions the piece where a BeamSearch would."""
+	global _policy_search
+	if _policy_search is None:
+		_policy_search = BeamSearch(beam_width=4, depth=2)
+	_policy_search.position(board)
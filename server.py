@@ -0,0 +1,296 @@
+"""An asyncio line-protocol game server.
+
+Each connection plays its own Board. Clients send one command per line:
+
+	left, right, rotate, rotate_ccw, down, drop, stats, quit
+
+and the server answers every change with a state line
+
+	state <score> <lines> <level> <shape>,<x>,<y>,<rotation> <rows>
+
+where shape indexes Piece.SHAPES (- when there's no piece) and rows are
+the row masks in hex, comma separated. "over <score>" ends a game.
+
+Gravity for every session is driven by one TimerWheel rather than a
+timer per game. `python -m server` serves, and `python -m server load
+--sessions 5000` runs a load test against a server.
+"""
+import argparse
+import asyncio
+import time
+from collections import deque
+from random import Random
+
+from engine import Board, Piece, level_speed
+import replay
+
+COMMANDS = {
+	"left" : replay.LEFT,
+	"right" : replay.RIGHT,
+	"rotate" : replay.ROTATE_CW,
+	"rotate_ccw" : replay.ROTATE_CCW,
+	"down" : replay.DOWN,
+	"drop" : replay.FULL_DROP,
+}
+
+# Longest line a client may send; longer ones close the connection
+MAX_LINE = 256
+
+
+class TimerWheel:
+	"""Runs callbacks after a delay, to the nearest `resolution` seconds.
+
+	Callbacks wait in one of `slots` buckets, so scheduling and firing are
+	O(1) however many are pending; delays must be shorter than slots *
+	resolution. Tick lateness is kept for the last `window` ticks."""
+
+	def __init__(self, resolution=0.005, slots=512, window=2000):
+		self.resolution = resolution
+		self.buckets = [[] for i in range(slots)]
+		self.tick = 0
+		self.lateness = deque(maxlen=window)
+		self.max_lateness = 0.0
+		self.fired = 0
+
+	def schedule(self, delay, callback):
+		ticks = max(1, round(delay / self.resolution))
+		if ticks >= len(self.buckets):
+			raise ValueError("delay {}s is longer than the wheel".format(delay))
+		self.buckets[(self.tick + ticks) % len(self.buckets)].append(callback)
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		start = loop.time()
+		buckets = self.buckets
+		while True:
+			self.tick += 1
+			deadline = start + self.tick * self.resolution
+			delay = deadline - loop.time()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			late = loop.time() - deadline
+			self.lateness.append(late)
+			if late > self.max_lateness:
+				self.max_lateness = late
+
+			i = self.tick % len(buckets)
+			callbacks = buckets[i]
+			buckets[i] = []
+			self.fired += len(callbacks)
+			for callback in callbacks:
+				callback()
+
+	def jitter(self):
+		"""Returns (p50, p99, max) tick lateness in milliseconds."""
+		late = sorted(self.lateness)
+		if not late:
+			return (0.0, 0.0, 0.0)
+		return (late[len(late) // 2] * 1000, late[int(len(late) * 0.99)] * 1000,
+		        self.max_lateness * 1000)
+
+
+class Session(asyncio.Protocol):
+	"""One connection and its Board."""
+
+	def __init__(self, server):
+		self.server = server
+		self.transport = None
+		self.board = Board(10, 20, seed=server.rand.getrandbits(32))
+		self.board.generate_piece()
+		self.buffer = b""
+		self.closed = False
+		# While the client isn't keeping up, state lines are skipped; the
+		# latest state is sent once it catches up
+		self.paused = False
+		self.sent_revision = None
+
+	def connection_made(self, transport):
+		self.transport = transport
+		self.server.sessions.add(self)
+		self.send_state()
+		self.schedule()
+
+	def connection_lost(self, exc):
+		self.closed = True
+		self.server.sessions.discard(self)
+
+	def pause_writing(self):
+		self.paused = True
+
+	def resume_writing(self):
+		self.paused = False
+		self.send_state()
+
+	def data_received(self, data):
+		lines = (self.buffer + data).split(b"\n")
+		self.buffer = lines.pop()
+		for line in lines:
+			if self.closed:
+				return
+			# Anything that isn't UTF-8 is just an unknown command
+			self.command(line.strip().decode(errors="replace"))
+		if len(self.buffer) > MAX_LINE and not self.closed:
+			self.transport.write(b"error line too long\n")
+			self.close()
+
+	def schedule(self):
+		interval = max(level_speed(self.board.level), 5) / 1000
+		self.server.wheel.schedule(interval, self.gravity)
+
+	def gravity(self):
+		if self.closed:
+			return
+		self.board.drop_piece()
+		self.send_state()
+		if not self.closed:
+			self.schedule()
+
+	def command(self, line):
+		if line in COMMANDS:
+			replay.apply(self.board, COMMANDS[line])
+			self.send_state()
+		elif line == "stats":
+			self.transport.write(self.server.stats_line().encode())
+		elif line == "quit":
+			self.close()
+		else:
+			self.transport.write(b"error unknown command\n")
+
+	def send_state(self):
+		b = self.board
+		if b.game_over:
+			self.transport.write("over {}\n".format(b.score).encode())
+			self.close()
+			return
+		if self.paused or b.revision == self.sent_revision:
+			return
+		self.sent_revision = b.revision
+		p = b.piece
+		if p is None:
+			piece = "-"
+		else:
+			piece = "{},{},{},{}".format(Piece.SHAPES.index(p.shape), p.x, p.y, p.rotation)
+		self.transport.write("state {} {} {} {} {}\n".format(
+			b.score, b.lines, b.level, piece,
+			",".join("{:x}".format(mask) for mask in b.rows)).encode())
+
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			self.transport.close()
+
+
+class GameServer:
+	def __init__(self, seed=None, resolution=0.005):
+		# Enough slots for the slowest drop interval, at level 1
+		self.wheel = TimerWheel(resolution, int(level_speed(1) / 1000 / resolution) + 2)
+		self.sessions = set()
+		self.rand = Random(seed)
+
+	def stats_line(self):
+		return "stats {} {:.2f} {:.2f} {:.2f}\n".format(len(self.sessions), *self.wheel.jitter())
+
+	async def start(self, host="127.0.0.1", port=7777):
+		"""Starts listening and ticking, returning the asyncio server."""
+		loop = asyncio.get_running_loop()
+		self.wheel_task = asyncio.ensure_future(self.wheel.run())
+		return await loop.create_server(lambda: Session(self), host, port, backlog=4096)
+
+	async def serve(self, host="127.0.0.1", port=7777):
+		server = await self.start(host, port)
+		try:
+			async with server:
+				await server.serve_forever()
+		finally:
+			self.wheel_task.cancel()
+
+
+async def _client(host, port, seconds, rate, rand, counts):
+	"""One load-test connection sending random commands at about `rate`
+	per second, counting the lines it gets back."""
+	reader, writer = await asyncio.open_connection(host, port)
+	names = list(COMMANDS)
+	loop = asyncio.get_running_loop()
+	stop = loop.time() + seconds
+
+	async def read():
+		while True:
+			line = await reader.readline()
+			if not line:
+				return
+			counts["lines"] += 1
+			if line.startswith(b"over"):
+				counts["games_over"] += 1
+				return
+
+	reading = asyncio.ensure_future(read())
+	try:
+		while loop.time() < stop and not reading.done():
+			await asyncio.sleep(rand.expovariate(rate))
+			writer.write((rand.choice(names) + "\n").encode())
+			counts["commands"] += 1
+	except ConnectionError:
+		pass
+	finally:
+		reading.cancel()
+		writer.close()
+
+async def load_test(host="127.0.0.1", port=7777, sessions=5000, seconds=10.0,
+                    rate=2.0, seed=0):
+	"""Holds `sessions` connections open for `seconds`, each sending `rate`
+	commands per second, then asks the server for its tick jitter."""
+	rand = Random(seed)
+	counts = {"lines" : 0, "commands" : 0, "games_over" : 0}
+	clients = []
+	for i in range(sessions):
+		clients.append(asyncio.ensure_future(
+			_client(host, port, seconds, rate, Random(rand.random()), counts)))
+		if i % 100 == 99:
+			# Don't overflow the server's listen backlog
+			await asyncio.sleep(0.01)
+	results = await asyncio.gather(*clients, return_exceptions=True)
+	errors = [r for r in results if isinstance(r, Exception)]
+
+	reader, writer = await asyncio.open_connection(host, port)
+	writer.write(b"stats\n")
+	stats = None
+	while True:
+		line = await reader.readline()
+		if not line or line.startswith(b"stats"):
+			stats = line.decode().split()[1:]
+			break
+	writer.close()
+	return counts, errors, stats
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Line-protocol tetris server.")
+	parser.add_argument("command", nargs="?", default="serve", choices=("serve", "load"))
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=7777)
+	parser.add_argument("--sessions", type=int, default=5000, help="load test connections")
+	parser.add_argument("--seconds", type=float, default=10.0, help="load test length")
+	parser.add_argument("--rate", type=float, default=2.0,
+	                    help="load test commands per second per connection")
+	args = parser.parse_args(argv)
+
+	if args.command == "serve":
+		try:
+			asyncio.run(GameServer().serve(args.host, args.port))
+		except KeyboardInterrupt:
+			pass
+		return
+
+	start = time.perf_counter()
+	counts, errors, stats = asyncio.run(load_test(
+		args.host, args.port, args.sessions, args.seconds, args.rate))
+	elapsed = time.perf_counter() - start
+	print("{} sessions for {:.1f}s: {} commands, {} state lines, {} games over, {} errors".format(
+		args.sessions, elapsed, counts["commands"], counts["lines"],
+		counts["games_over"], len(errors)))
+	if stats:
+		print("server: {} sessions, tick lateness p50 {} ms, p99 {} ms, max {} ms".format(*stats))
+
+
+if __name__ == "__main__":
+	main()
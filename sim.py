@@ -0,0 +1,156 @@
+"""Headless game simulator.
+
+Plays seeded games without pygame, spreading them over a process pool, and
+reports throughput. Run with `python -m sim --games 1000`.
+"""
+import argparse
+import importlib
+import time
+from multiprocessing import Pool, cpu_count
+from random import Random
+
+from engine import AnsiView, Board
+import search
+
+
+def random_policy(board, rand):
+	"""Rotates and shifts the current piece at random."""
+	for _ in range(rand.randrange(4)):
+		board.rotate_piece()
+	board.move_piece(rand.randrange(-board.width // 2, board.width // 2 + 1), 0)
+
+
+POLICIES = {
+	"random" : random_policy,
+	"beam" : search.beam_policy,
+}
+
+def get_policy(name):
+	"""Looks up a policy by name, or imports one given as "module:function"."""
+	if name in POLICIES:
+		return POLICIES[name]
+	module, _, attr = name.partition(":")
+	return getattr(importlib.import_module(module), attr)
+
+
+def play_game(seed, policy=random_policy, width=10, height=20, max_pieces=None,
+              observer=None):
+	"""Plays one game to the end, returning (placements, lines, score).
+
+	The policy is called once per piece with the board and a Random seeded
+	from the game seed, and should position board.piece; the piece is then
+	hard dropped. If given, observer(board, shape, lines) is called after
+	each placement with the shape placed and the lines it cleared."""
+	b = Board(width, height)
+	b.rand.seed(seed)
+	rand = Random(seed)
+	b.generate_piece()
+
+	placements = 0
+	while not b.game_over and (max_pieces is None or placements < max_pieces):
+		policy(b, rand)
+		if observer is None:
+			b.full_drop_piece()
+		else:
+			shape = b.piece.shape
+			lines = b.lines
+			b.full_drop_piece()
+			observer(b, shape, b.lines - lines)
+		placements += 1
+	return (placements, b.lines, b.score)
+
+def watch(seed, policy=random_policy, width=10, height=20, fps=30, out=None):
+	"""Plays one game, drawing every placement to the terminal."""
+	b = Board(width, height)
+	b.rand.seed(seed)
+	rand = Random(seed)
+	v = AnsiView(out=out)
+	b.generate_piece()
+	b.attach(v)
+	try:
+		while not b.game_over:
+			policy(b, rand)
+			v.show()
+			if fps:
+				time.sleep(1.0 / fps)
+			b.full_drop_piece()
+		v.show()
+		v.show_game_over()
+	finally:
+		v.close()
+	return (b.lines, b.score)
+
+def _play(args):
+	seed, policy_name, width, height, max_pieces = args
+	return play_game(seed, get_policy(policy_name), width, height, max_pieces)
+
+
+def run(games, policy="random", processes=None, width=10, height=20,
+        max_pieces=None, seed=0):
+	"""Plays games seeded seed..seed+games-1 and returns a stats dict."""
+	tasks = ((seed + i, policy, width, height, max_pieces) for i in range(games))
+	processes = processes or cpu_count()
+
+	start = time.perf_counter()
+	# Totals are summed as results arrive so memory doesn't grow with games
+	placements = lines = score = 0
+	pool = None
+	if processes == 1:
+		results = map(_play, tasks)
+	else:
+		chunksize = max(1, games // (processes * 8))
+		pool = Pool(processes)
+		results = pool.imap_unordered(_play, tasks, chunksize)
+	try:
+		for r in results:
+			placements += r[0]
+			lines += r[1]
+			score += r[2]
+	finally:
+		if pool is not None:
+			pool.terminate()
+	elapsed = time.perf_counter() - start
+
+	return {
+		"games" : games,
+		"processes" : processes,
+		"seconds" : elapsed,
+		"placements" : placements,
+		"lines" : lines,
+		"score" : score,
+		"games_per_sec" : games / elapsed,
+		"placements_per_sec" : placements / elapsed,
+		"lines_per_sec" : lines / elapsed,
+	}
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument("--games", type=int, default=1000)
+	parser.add_argument("--policy", default="random",
+	                    help="policy name or module:function")
+	parser.add_argument("--processes", type=int, default=None,
+	                    help="worker processes (default: all cores)")
+	parser.add_argument("--width", type=int, default=10)
+	parser.add_argument("--height", type=int, default=20)
+	parser.add_argument("--max-pieces", type=int, default=None)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--watch", action="store_true",
+	                    help="draw one game in the terminal instead")
+	parser.add_argument("--fps", type=float, default=30)
+	args = parser.parse_args(argv)
+
+	if args.watch:
+		watch(args.seed, get_policy(args.policy), args.width, args.height, args.fps)
+		return
+
+	stats = run(args.games, args.policy, args.processes, args.width,
+	            args.height, args.max_pieces, args.seed)
+	print("{games} games on {processes} processes in {seconds:.2f}s".format(**stats))
+	print("games/sec:      {games_per_sec:.1f}".format(**stats))
+	print("placements/sec: {placements_per_sec:.0f}".format(**stats))
+	print("lines/sec:      {lines_per_sec:.1f}".format(**stats))
+
+
+if __name__ == "__main__":
+	main()
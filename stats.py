@@ -0,0 +1,270 @@
+"""Streaming statistics for simulated games.
+
+`python -m stats record --games 1000000 -o games.tstats` plays games on
+all cores and streams per-game and per-placement columns to a file in
+chunks, and `python -m stats summary games.tstats` summarizes a file of
+any size a chunk at a time.
+
+The file is a sequence of chunks, each a header (magic, table, row
+count) followed by one array.array of raw values per column of that
+table. Memory use is bounded by the chunk size, however many games are
+run or read.
+"""
+import argparse
+import math
+import struct
+import sys
+import time
+from array import array
+from collections import Counter
+from multiprocessing import Pool, cpu_count
+
+from engine import Piece
+import sim
+
+MAGIC = b"TSTC"
+_HEADER = struct.Struct("<4sBI")
+
+# Tables, each a tuple of (column name, array typecode)
+GAMES = 0
+PLACEMENTS = 1
+TABLES = {
+	GAMES : (("seed", "q"), ("placements", "I"), ("score", "Q"),
+	         ("lines", "I"), ("level", "H")),
+	# In game order, each game's rows counted by its "placements"
+	PLACEMENTS : (("shape", "B"), ("cleared", "B"), ("stack", "B")),
+}
+
+for _columns in TABLES.values():
+	for _name, _code in _columns:
+		# The file is little endian and sized by the typecodes
+		assert array(_code).itemsize == struct.calcsize("<" + _code)
+del _columns, _name, _code
+
+
+class Aggregate:
+	"""Running totals over games and placements, in constant memory."""
+
+	def __init__(self):
+		self.games = 0
+		self.placements = 0
+		self.score_total = 0
+		self.score_max = 0
+		# Welford's running mean and variance of score
+		self.score_mean = 0.0
+		self.score_m2 = 0.0
+		self.lines_total = 0
+		self.lines_max = 0
+		self.levels = Counter()
+		self.shapes = [0] * len(Piece.SHAPES)
+		self.clears = [0] * 5
+		self.stacks = Counter()
+
+	def add_game(self, placements, score, lines, level):
+		self.games += 1
+		self.score_total += score
+		self.score_max = max(self.score_max, score)
+		delta = score - self.score_mean
+		self.score_mean += delta / self.games
+		self.score_m2 += delta * (score - self.score_mean)
+		self.lines_total += lines
+		self.lines_max = max(self.lines_max, lines)
+		self.levels[level] += 1
+
+	def add_placements(self, shapes, cleared, stacks):
+		"""Counts placements given as bytes-like columns of shape indices,
+		lines cleared and stack heights."""
+		self.placements += len(shapes)
+		for i, n in Counter(shapes).items():
+			self.shapes[i] += n
+		for i, n in Counter(cleared).items():
+			self.clears[i] += n
+		self.stacks.update(stacks)
+
+	def summary(self):
+		games = self.games or 1
+		return {
+			"games" : self.games,
+			"placements" : self.placements,
+			"score_mean" : self.score_mean,
+			"score_stdev" : math.sqrt(self.score_m2 / games),
+			"score_max" : self.score_max,
+			"lines_mean" : self.lines_total / games,
+			"lines_max" : self.lines_max,
+			"levels" : dict(sorted(self.levels.items())),
+			"shapes" : self.shapes,
+			"clears" : self.clears,
+			"stack_max" : max(self.stacks) if self.stacks else 0,
+			"stack_mean" : (sum(h * n for h, n in self.stacks.items())
+			                / (self.placements or 1)),
+		}
+
+
+class StatsWriter:
+	"""Buffers rows in arrays and appends them to a file a chunk at a time."""
+
+	def __init__(self, path, chunk_rows=65536):
+		self.f = open(path, "ab")
+		self.chunk_rows = chunk_rows
+		self.buffers = {table : [array(code) for name, code in columns]
+		                for table, columns in TABLES.items()}
+
+	def add_game(self, seed, placements, score, lines, level):
+		buffers = self.buffers[GAMES]
+		for column, value in zip(buffers, (seed, placements, score, lines, level)):
+			column.append(value)
+		if len(buffers[0]) >= self.chunk_rows:
+			self.flush(GAMES)
+
+	def add_placements(self, shapes, cleared, stacks):
+		buffers = self.buffers[PLACEMENTS]
+		buffers[0].frombytes(shapes)
+		buffers[1].frombytes(cleared)
+		buffers[2].frombytes(stacks)
+		if len(buffers[0]) >= self.chunk_rows:
+			self.flush(PLACEMENTS)
+
+	def flush(self, table=None):
+		for t in ((table,) if table is not None else TABLES):
+			buffers = self.buffers[t]
+			if not buffers[0]:
+				continue
+			self.f.write(_HEADER.pack(MAGIC, t, len(buffers[0])))
+			for column in buffers:
+				if sys.byteorder != "little":
+					column.byteswap()
+				column.tofile(self.f)
+				del column[:]
+
+	def close(self):
+		self.flush()
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def read_chunks(path):
+	"""Yields (table, {column name: array}) for each chunk in a file,
+	reading one chunk at a time."""
+	with open(path, "rb") as f:
+		while True:
+			header = f.read(_HEADER.size)
+			if not header:
+				return
+			magic, table, n = _HEADER.unpack(header)
+			if magic != MAGIC:
+				raise ValueError("{} is not a stats file".format(path))
+			columns = {}
+			for name, code in TABLES[table]:
+				column = array(code)
+				column.fromfile(f, n)
+				if sys.byteorder != "little":
+					column.byteswap()
+				columns[name] = column
+			yield table, columns
+
+def summarize(path):
+	"""Returns an Aggregate of everything in a stats file."""
+	agg = Aggregate()
+	for table, columns in read_chunks(path):
+		if table == GAMES:
+			for row in zip(columns["placements"], columns["score"],
+			               columns["lines"], columns["level"]):
+				agg.add_game(*row)
+		else:
+			agg.add_placements(columns["shape"], columns["cleared"],
+			                   columns["stack"])
+	return agg
+
+
+def _play(args):
+	"""Plays a game, returning its row and its placement columns as bytes."""
+	seed, policy_name, width, height, max_pieces = args
+	shapes = bytearray()
+	cleared = bytearray()
+	stacks = bytearray()
+	index = {id(shape) : i for i, shape in enumerate(Piece.SHAPES)}
+	def observer(board, shape, lines):
+		shapes.append(index[id(shape)])
+		cleared.append(lines)
+		stacks.append(min(255, board.height - min(board.columns)))
+	placements, lines, score = sim.play_game(
+		seed, sim.get_policy(policy_name), width, height, max_pieces, observer)
+	level = lines // 10 + 1
+	return ((seed, placements, score, lines, level),
+	        bytes(shapes), bytes(cleared), bytes(stacks))
+
+
+def record(path, games, policy="random", processes=None, width=10, height=20,
+           max_pieces=None, seed=0, chunk_rows=65536):
+	"""Plays games seeded seed..seed+games-1, appending their stats to path.
+	Returns the Aggregate of the games played."""
+	processes = processes or cpu_count()
+	pool = Pool(processes) if processes > 1 else None
+	# Pool.imap queues every task up front, so games are handed out in
+	# batches to keep that queue (and memory) bounded too
+	batch = processes * 256
+	agg = Aggregate()
+	try:
+		with StatsWriter(path, chunk_rows) as writer:
+			for first in range(seed, seed + games, batch):
+				tasks = [(i, policy, width, height, max_pieces)
+				         for i in range(first, min(first + batch, seed + games))]
+				if pool is None:
+					results = map(_play, tasks)
+				else:
+					results = pool.imap_unordered(_play, tasks, 16)
+				for game, shapes, cleared, stacks in results:
+					writer.add_game(*game)
+					writer.add_placements(shapes, cleared, stacks)
+					agg.add_game(*game[1:])
+					agg.add_placements(shapes, cleared, stacks)
+	finally:
+		if pool is not None:
+			pool.terminate()
+	return agg
+
+
+def print_summary(summary):
+	names = "LROTSZI"    # Piece.SHAPES in order
+	print("{games} games, {placements} placements".format(**summary))
+	print("score: mean {score_mean:.1f}, stdev {score_stdev:.1f}, max {score_max}".format(**summary))
+	print("lines: mean {lines_mean:.2f}, max {lines_max}".format(**summary))
+	print("levels reached:", summary["levels"])
+	print("pieces:", dict(zip(names, summary["shapes"])))
+	print("clears by size:", dict(enumerate(summary["clears"])))
+	print("stack height: mean {stack_mean:.2f}, max {stack_max}".format(**summary))
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Streaming game statistics.")
+	sub = parser.add_subparsers(dest="command", required=True)
+	rec = sub.add_parser("record", help="play games and append their stats to a file")
+	rec.add_argument("-o", "--output", required=True)
+	rec.add_argument("--games", type=int, default=1000)
+	rec.add_argument("--policy", default="random")
+	rec.add_argument("--processes", type=int, default=None)
+	rec.add_argument("--width", type=int, default=10)
+	rec.add_argument("--height", type=int, default=20)
+	rec.add_argument("--max-pieces", type=int, default=None)
+	rec.add_argument("--seed", type=int, default=0)
+	summary = sub.add_parser("summary", help="summarize a stats file")
+	summary.add_argument("path")
+	args = parser.parse_args(argv)
+
+	start = time.perf_counter()
+	if args.command == "record":
+		agg = record(args.output, args.games, args.policy, args.processes,
+		             args.width, args.height, args.max_pieces, args.seed)
+	else:
+		agg = summarize(args.path)
+	print_summary(agg.summary())
+	print("{:.2f}s".format(time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+	main()
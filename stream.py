@@ -0,0 +1,231 @@
+"""Delta-compressed board streaming for spectators.
+
+FrameEncoder turns successive states of one Board into frames holding
+only what changed since the previous frame: changed rows as a bitmask
+plus runs of tile colors, the piece pose, and score, lines and level
+when they change. Every `keyframe_every` frames it sends the whole board
+so a lost or late subscriber can resynchronise. FrameDecoder applies
+frames and renders the result to any ViewBase.
+
+A frame is a flags byte, then whichever of these the flags call for:
+
+	size        varint width, height (keyframes only)
+	rows        varint count, then per row: varint y, varint mask,
+	            varint run count, (varint length, color byte) per run
+	piece       shape + 1 (0 for none), zigzag x, zigzag y, rotation
+	score, lines, level    varints
+"""
+from engine import Color, Piece
+from replay import read_varint, unzigzag, write_varint, zigzag
+
+KEYFRAME = 1
+ROWS = 2
+PIECE = 4
+SCORE = 8
+LINES = 16
+LEVEL = 32
+GAME_OVER = 64
+
+
+def _write_row(buf, y, mask, colors):
+	write_varint(buf, y)
+	write_varint(buf, mask)
+	runs = []
+	color = None
+	x = 0
+	while mask >> x:
+		if mask >> x & 1:
+			c = colors[x]
+			if c == color:
+				runs[-1][0] += 1
+			else:
+				color = c
+				runs.append([1, c])
+		x += 1
+	write_varint(buf, len(runs))
+	for length, c in runs:
+		write_varint(buf, length)
+		buf.append(c)
+
+
+class FrameEncoder:
+	def __init__(self, board, keyframe_every=60):
+		self.board = board
+		self.keyframe_every = keyframe_every
+		self.frames = 0
+		self.sent_rows = None
+		self.sent_colors = None
+		self.sent_piece = None
+		self.sent_stats = (None, None, None)
+		self.sent_game_over = False
+
+	def encode(self, keyframe=False):
+		"""Returns the next frame, or None if nothing visible changed."""
+		b = self.board
+		keyframe = (keyframe or self.sent_rows is None
+		            or self.frames % self.keyframe_every == 0)
+		flags = KEYFRAME if keyframe else 0
+		body = bytearray()
+
+		rows = b.rows
+		colors = b.colors
+		if keyframe:
+			write_varint(body, b.width)
+			write_varint(body, b.height)
+			changed = [y for y in range(b.height) if rows[y]]
+		else:
+			sent_rows = self.sent_rows
+			sent_colors = self.sent_colors
+			# Color rows are immutable bytes, replaced rather than modified,
+			# so an unchanged row is the very same object
+			changed = [y for y in range(b.height)
+			           if rows[y] != sent_rows[y] or colors[y] is not sent_colors[y]]
+		if changed or keyframe:
+			flags |= ROWS
+			write_varint(body, len(changed))
+			for y in changed:
+				_write_row(body, y, rows[y], colors[y])
+		self.sent_rows = list(rows)
+		self.sent_colors = list(colors)
+
+		p = b.piece
+		piece = None if p is None else (p.shape, p.x, p.y, p.rotation)
+		if keyframe or piece != self.sent_piece:
+			flags |= PIECE
+			if piece is None:
+				body.append(0)
+			else:
+				body.append(Piece.SHAPES.index(p.shape) + 1)
+				write_varint(body, zigzag(p.x))
+				write_varint(body, zigzag(p.y))
+				body.append(p.rotation)
+			self.sent_piece = piece
+
+		for flag, value, sent in zip((SCORE, LINES, LEVEL),
+		                             (b.score, b.lines, b.level), self.sent_stats):
+			if keyframe or value != sent:
+				flags |= flag
+				write_varint(body, value)
+		self.sent_stats = (b.score, b.lines, b.level)
+		over_changed = b.game_over != self.sent_game_over
+		self.sent_game_over = b.game_over
+		if b.game_over:
+			flags |= GAME_OVER
+
+		if flags & ~GAME_OVER == 0 and not over_changed:
+			return None
+		self.frames += 1
+		return bytes((flags,)) + bytes(body)
+
+
+class FrameDecoder:
+	"""Rebuilds a board's tiles, piece and scores from frames."""
+
+	def __init__(self):
+		self.width = self.height = 0
+		self.grid = []
+		self.piece = None
+		self.score = self.lines = 0
+		self.level = 1
+		self.game_over = False
+		self.synced = False
+
+	def decode(self, frame):
+		"""Applies a frame. Deltas before the first keyframe are ignored."""
+		flags = frame[0]
+		pos = 1
+		if flags & KEYFRAME:
+			self.width, pos = read_varint(frame, pos)
+			self.height, pos = read_varint(frame, pos)
+			self.grid = [bytearray(self.width) for y in range(self.height)]
+			self.synced = True
+		elif not self.synced:
+			return
+
+		if flags & ROWS:
+			n, pos = read_varint(frame, pos)
+			for i in range(n):
+				y, pos = read_varint(frame, pos)
+				mask, pos = read_varint(frame, pos)
+				n_runs, pos = read_varint(frame, pos)
+				colors = bytearray()
+				for r in range(n_runs):
+					length, pos = read_varint(frame, pos)
+					colors += bytes((frame[pos],)) * length
+					pos += 1
+				row = self.grid[y]
+				colors = iter(colors)
+				for x in range(self.width):
+					row[x] = next(colors) if mask >> x & 1 else Color.CLEAR
+
+		if flags & PIECE:
+			shape = frame[pos]
+			pos += 1
+			if shape:
+				x, pos = read_varint(frame, pos)
+				y, pos = read_varint(frame, pos)
+				self.piece = (Piece.SHAPES[shape - 1], unzigzag(x), unzigzag(y), frame[pos])
+				pos += 1
+			else:
+				self.piece = None
+
+		if flags & SCORE:
+			self.score, pos = read_varint(frame, pos)
+		if flags & LINES:
+			self.lines, pos = read_varint(frame, pos)
+		if flags & LEVEL:
+			self.level, pos = read_varint(frame, pos)
+		self.game_over = bool(flags & GAME_OVER)
+
+	def render(self, v):
+		# set_size() clears the view
+		v.set_size(self.width, self.height)
+		for y, row in enumerate(self.grid):
+			if any(row):
+				v.render_row(y, row)
+		if self.piece is not None:
+			shape, x, y, rotation = self.piece
+			piece = Piece(x, y, shape, shape["color"], rotation)
+			# The ghost goes where the piece would land, as in Board.render()
+			columns = [next((row for row in range(self.height)
+			                 if self.grid[row][col] != Color.CLEAR), self.height)
+			           for col in range(self.width)]
+			ghost_y = min(columns[x + dx] - dy - 1
+			              for dx, dy in shape["profiles"][rotation]) - y
+			for tx, ty in piece:
+				v.render_ghost(tx, ty + ghost_y, piece.color)
+			v.render_piece(piece)
+		v.set_score(self.score)
+		v.set_level(self.level)
+
+
+class Broadcaster:
+	"""Encodes a board once per frame and hands the same bytes to every
+	subscriber. A new subscriber first gets the frames since the last
+	keyframe, so it can start decoding straight away."""
+
+	def __init__(self, board, keyframe_every=60):
+		self.encoder = FrameEncoder(board, keyframe_every)
+		self.subscribers = []
+		self.since_keyframe = []
+
+	def subscribe(self, callback):
+		"""Calls callback(frame) with every frame from now on."""
+		for frame in self.since_keyframe:
+			callback(frame)
+		self.subscribers.append(callback)
+
+	def unsubscribe(self, callback):
+		self.subscribers.remove(callback)
+
+	def publish(self):
+		"""Encodes the board's changes, if any, and sends them out."""
+		frame = self.encoder.encode()
+		if frame is None:
+			return None
+		if frame[0] & KEYFRAME:
+			self.since_keyframe = []
+		self.since_keyframe.append(frame)
+		for callback in self.subscribers:
+			callback(frame)
+		return frame
@@ -0,0 +1,62 @@
+import nose
+import numpy as np
+from random import Random
+
+from engine import *
+from batch import BoardBatch
+
+def board_grid(b):
+	return [list(row) for row in b.colors]
+
+class TestBoardBatch:
+	def setUp(self):
+		self.k = 16
+		self.batch = BoardBatch(self.k, 6, 10, seed=3, autogen=False)
+		self.boards = [Board(6, 10, autogen=False) for i in range(self.k)]
+		self.spawn(np.ones(self.k, dtype=bool))
+
+	def spawn(self, mask):
+		shapes = self.batch.rng.integers(len(Piece.SHAPES), size=self.k)
+		self.batch.generate_piece(mask, shapes)
+		for i in np.flatnonzero(mask):
+			self.boards[i].generate_piece(Piece.SHAPES[shapes[i]])
+
+	def check(self):
+		for i, b in enumerate(self.boards):
+			assert self.batch.grid[i].tolist() == board_grid(b)
+			assert self.batch.columns[i].tolist() == b.columns
+			assert self.batch.score[i] == b.score
+			assert self.batch.lines[i] == b.lines
+			assert self.batch.game_over[i] == b.game_over
+			assert self.batch.has_piece[i] == (b.piece is not None)
+			if b.piece is not None:
+				assert (self.batch.x[i], self.batch.y[i], self.batch.rotation[i]) == \
+				       (b.piece.x, b.piece.y, b.piece.rotation)
+
+	def test_matches_board(self):
+		r = Random(1)
+		for step in range(400):
+			action = np.array([r.randrange(6) for i in range(self.k)])
+			self.batch.move_piece(-1, 0, action == 0)
+			self.batch.move_piece(1, 0, action == 1)
+			self.batch.rotate_piece(True, action == 2)
+			self.batch.rotate_piece(False, action == 3)
+			self.batch.drop_piece(action == 4)
+			self.batch.full_drop_piece(action == 5)
+			for b, a in zip(self.boards, action):
+				if a == 0:
+					b.move_piece(-1, 0)
+				elif a == 1:
+					b.move_piece(1, 0)
+				elif a == 2:
+					b.rotate_piece(True)
+				elif a == 3:
+					b.rotate_piece(False)
+				elif a == 4:
+					b.drop_piece()
+				elif a == 5:
+					b.full_drop_piece()
+			self.spawn(~self.batch.has_piece & ~self.batch.game_over)
+			self.check()
+		assert self.batch.lines.sum() > 0
+		assert self.batch.game_over.any()
@@ -0,0 +1,49 @@
+import nose
+import numpy as np
+from random import Random
+
+import env
+from engine import *
+
+class TestVecEnv:
+	def setUp(self):
+		self.env = env.VecEnv(6, 6, 10)
+		self.obs = self.env.reset(seeds=range(6))
+
+	def tearDown(self):
+		self.env.close()
+
+	def test_observations(self):
+		r = Random(1)
+		for i in range(200):
+			obs, reward, done = self.env.step([r.randrange(env.N_ACTIONS) for b in range(6)])
+			# The same buffers come back every step
+			assert obs["grid"] is self.obs["grid"]
+			for b, grid, piece, columns in zip(self.env.local.boards, obs["grid"],
+			                                   obs["piece"], obs["columns"]):
+				assert grid.tolist() == [[m >> x & 1 for x in range(6)] for m in b.rows]
+				assert columns.tolist() == [10 - top for top in b.columns]
+				assert piece.tolist() == [Piece.SHAPES.index(b.piece.shape) + 1,
+				                          b.piece.rotation, b.piece.x, b.piece.y]
+
+	def test_processes(self):
+		with env.VecEnv(6, 6, 10, processes=2) as shared:
+			shared.reset(seeds=range(6))
+			r = Random(2)
+			for i in range(200):
+				actions = [r.randrange(env.N_ACTIONS) for b in range(6)]
+				obs, reward, done = self.env.step(actions)
+				s_obs, s_reward, s_done = shared.step(actions)
+				for name in obs:
+					assert np.array_equal(obs[name], s_obs[name])
+				assert np.array_equal(reward, s_reward)
+				assert np.array_equal(done, s_done)
+
+	def test_read_after_close(self):
+		shared = env.VecEnv(6, 6, 10, processes=2)
+		obs = shared.reset(seeds=range(6))
+		obs, reward, done = shared.step([env.NOOP] * 6)
+		expected = obs["grid"].copy()
+		shared.close()
+		assert np.array_equal(obs["grid"], expected)
+		assert reward.shape == (6,) and not done.any()
@@ -1,5 +1,19 @@
+import asyncio
+import io
+import os
+import tempfile
+
 import nose
 from engine import *
+from instrument import FrameTimer
+import server
+import sim
+import stats
+import tune
+import replay
+import search
+import stream
+from search import TranspositionCache
 
 class TestTextView:
 	def setUp(self):
@@ -21,6 +35,42 @@ class TestTextView:
 		self.tr.show()
 		assert self.tr.get_str() == COLOR_BOARD
 
+class TestAnsiView:
+	def setUp(self):
+		self.out = io.StringIO()
+		self.v = AnsiView(out=self.out)
+		self.v.set_size(5, 3)
+
+	def test_full_then_diff(self):
+		self.v.show()
+		assert self.out.getvalue().startswith("\x1b[2J")
+		assert "\x1b[3;1H....." in self.out.getvalue()
+
+		self.out.seek(0)
+		self.out.truncate()
+		self.v.render_tile(2, 1, Color.RED)
+		self.v.render_tile(3, 1, Color.BLUE)
+		self.v.show()
+		assert self.out.getvalue() == "\x1b[2;3H*#\x1b[4;1H"
+
+	def test_no_change_writes_nothing(self):
+		self.v.show()
+		self.out.seek(0)
+		self.out.truncate()
+		self.v.show()
+		assert self.out.getvalue() == ""
+
+	def test_close_shows_cursor(self):
+		self.v.close()
+		assert self.out.getvalue() == ""
+		self.v.show()
+		self.v.close()
+		assert self.out.getvalue().endswith("\x1b[4;1H\x1b[?25h\n")
+		self.out.seek(0)
+		self.out.truncate()
+		self.v.close()
+		assert self.out.getvalue() == ""
+
 class TestPiece:
 	def setUp(self):
 		self.tr = TextView()
@@ -48,6 +98,13 @@ class TestPiece:
 				assert self.tr.get_str() == expected
 				p.rotate()
 
+	def test_rotation_tables(self):
+		for shape in Piece.SHAPES:
+			assert len(shape["rotations"]) == 4
+			assert shape["rotations"][0] == shape["tiles"]
+			p = Piece(2, 3, shape, Color.RED, 1)
+			assert list(p) == [(2 + x, 3 + y) for x, y in shape["rotations"][1]]
+
 class TestBoard:
 	def setUp(self):
 		self.tr = TextView()
@@ -131,6 +188,501 @@ class TestBoard:
 		print(self.b.columns)
 		assert self.b.columns == [4,4,3,5]
 
+	def test_clear_multiple_rows(self):
+		self.b = Board(4,6)
+		for x in range(4):
+			self.b.set_tile_color(x, 5, Color.RED)
+			self.b.set_tile_color(x, 3, Color.BLUE)
+		self.b.set_tile_color(2, 4, Color.GREEN)
+		self.b.set_tile_color(1, 2, Color.YELLOW)
+		assert self.b.row_counts == [0, 0, 1, 4, 1, 4]
+
+		self.b.clear_rows([3, 5])
+		assert self.b.rows == [0, 0, 0, 0, 0b10, 0b100]
+		assert self.b.row_counts == [0, 0, 0, 0, 1, 1]
+		assert self.b.get_tile_color(1, 4) == Color.YELLOW
+		assert self.b.get_tile_color(2, 5) == Color.GREEN
+		assert self.b.columns == [6, 4, 5, 6]
+
+	def test_finalize_clears_lines(self):
+		self.b = Board(4,6, autogen=False)
+		for x in range(3):
+			self.b.set_tile_color(x, 5, Color.RED)
+			self.b.set_tile_color(x, 4, Color.RED)
+		self.b.piece = Piece(3, 2, Piece.I_SHAPE, Color.RED, 1)
+		self.b.full_drop_piece()
+		assert self.b.lines == 2
+		assert self.b.score == 40
+		assert self.b.rows == [0, 0, 0, 0, 0b1000, 0b1000]
+
+	def test_landing_row(self):
+		self.b.set_tile_color(1, 3, Color.BLUE)
+		self.b.set_tile_color(3, 1, Color.GREEN)
+		for shape in Piece.SHAPES:
+			for rot in range(4):
+				for x in range(-1, 4):
+					self.b.piece = Piece(x, 0, shape, Color.RED, rot)
+					if not self.b.piece_can_move(0, 0):
+						continue
+					landing = self.b.landing_row(self.b.piece)
+					while self.b.piece_can_move(0, 1):
+						self.b.move_piece(0, 1)
+					assert landing == self.b.piece.y
+
+	def test_ghost(self):
+		ghost = []
+		self.tr.render_ghost = lambda x, y, color: ghost.append((x, y))
+		self.b.render(self.tr)
+		assert sorted(ghost) == [(0, 3), (1, 3), (1, 4), (2, 4)]
+		assert self.tr.get_str() == DROP_PIECE[0]
+
+	def test_revision(self):
+		rev = self.b.revision
+		self.b.move_piece(-1, 0)
+		assert self.b.revision == rev
+		self.b.move_piece(1, 0)
+		assert self.b.revision > rev
+		rev = self.b.revision
+		self.b.full_drop_piece()
+		assert self.b.revision > rev
+
+	def test_row_masks(self):
+		self.b.set_tile_color(0, 4, Color.BLUE)
+		self.b.set_tile_color(2, 4, Color.GREEN)
+		self.b.set_tile_color(2, 2, Color.GREEN)
+		assert self.b.rows == [0, 0, 0b100, 0, 0b101]
+		assert self.b.solid == [0, 0, 0b100, 0b100, 0b101]
+		assert self.b.get_tile_color(2, 4) == Color.GREEN
+		assert self.b.get_tile_color(1, 4) == Color.CLEAR
+
+	def test_color_plane(self):
+		self.b.set_tile_color(3, 4, Color.ORANGE)
+		assert self.b.colors[4] == bytes((0, 0, 0, Color.ORANGE))
+		assert self.b.get_tile_color(3, 4) is Color.ORANGE
+		self.b.render(self.tr)
+		assert self.tr.rows[4] == bytearray(b"\0\0\0\7")
+		assert self.tr.get_lines()[4] == "...$"
+
+	def test_clear_tile(self):
+		self.b.set_tile_color(1, 4, Color.BLUE)
+		self.b.set_tile_color(1, 3, Color.GREEN)
+		self.b.set_tile_color(1, 1, Color.RED)
+		self.b.clear_tile(1, 3)
+		assert self.b.rows == [0, 0, 0b10, 0, 0b10]
+		assert self.b.get_tile_color(1, 2) == Color.RED
+		assert self.b.get_tile_color(1, 4) == Color.BLUE
+		assert self.b.columns == [5, 2, 5, 5]
+
+	def test_no_slide_under_overhang(self):
+		self.b.piece = Piece(2, 1, Piece.I_SHAPE, Color.RED)
+		self.b.piece.rotate()
+		self.b.set_tile_color(0, 0, Color.BLUE)
+		assert self.b.piece_can_move(-1, 0)
+		assert not self.b.piece_can_move(-2, 0)
+
+	def test_piece_fits(self):
+		self.b.set_tile_color(1, 3, Color.BLUE)
+		self.b.set_tile_color(3, 1, Color.GREEN)
+		for shape in Piece.SHAPES:
+			for rot in range(4):
+				for x in range(-3, 5):
+					for y in range(-1, 6):
+						p = Piece(x, y, shape, Color.RED, rot)
+						expected = all(0 <= tx < 4 and ty < self.b.columns[tx]
+						               for tx, ty in p)
+						assert self.b.piece_fits(shape, x, y, rot) == expected
+
+	def test_snapshot_restore(self):
+		b = Board(10, 20, seed=5)
+		b.generate_piece()
+		b.full_drop_piece()
+		b.set_tile_color(0, 19, Color.BLUE)
+		state = b.snapshot()
+		self.tr.clear()
+		b.render(self.tr)
+		before = self.tr.get_str()
+		for i in range(5):
+			b.move_piece(-1, 0)
+			b.full_drop_piece()
+		b.clear_tile(0, 19)
+		b.restore(state)
+		assert b.snapshot() == state
+		self.tr.clear()
+		b.render(self.tr)
+		assert self.tr.get_str() == before
+		# The random generator is restored too
+		b.full_drop_piece()
+		first = b.piece.shape
+		b.restore(state)
+		b.full_drop_piece()
+		assert b.piece.shape is first
+
+	def test_legal_placements(self):
+		b = Board(8, 10, seed=2)
+		for i in range(3):
+			b.generate_piece()
+			b.move_piece(2 * i - 3, 0)
+			b.full_drop_piece()
+		for shape in Piece.SHAPES:
+			piece = Piece(3, 0, shape, Color.RED)
+			# Every resting position found by moving the piece a step at a time
+			queue = [(piece.x, piece.y, piece.rotation)]
+			seen = set(queue)
+			expected = set()
+			for x, y, rot in queue:
+				if not b.piece_fits(shape, x, y + 1, rot):
+					expected.add(frozenset(Piece(x, y, shape, Color.RED, rot)))
+				for state in ((x - 1, y, rot), (x + 1, y, rot), (x, y + 1, rot),
+				              (x, y, (rot + 1) % 4), (x, y, (rot - 1) % 4)):
+					if state not in seen and b.piece_fits(shape, *state):
+						seen.add(state)
+						queue.append(state)
+			found = [frozenset(Piece(x, y, shape, Color.RED, rot))
+			         for x, rot, y in b.legal_placements(piece)]
+			assert len(found) == len(set(found))
+			assert set(found) == expected
+		assert len(b.legal_placements(Piece(3, 0, Piece.O_SHAPE, Color.RED))) == 7
+
+	def test_zobrist(self):
+		b = Board(10, 20, seed=4)
+		assert b.zobrist == 0
+		b.generate_piece()
+		for i in range(6):
+			b.move_piece(i - 3, 0)
+			b.full_drop_piece()
+		b.clear_tile(4, 19)
+		b.clear_row(19)
+		other = Board(10, 20)
+		for y in range(20):
+			for x in range(10):
+				if b.rows[y] >> x & 1:
+					other.set_tile_color(x, y, Color.BLUE)
+		assert b.zobrist == other.zobrist != 0
+		other.piece = Piece(b.piece.x, b.piece.y, b.piece.shape, Color.RED)
+		assert b.state_key() == other.state_key()
+		other.move_piece(1, 0)
+		assert b.state_key() != other.state_key()
+		state = b.snapshot()
+		b.full_drop_piece()
+		b.restore(state)
+		assert b.zobrist == other.zobrist
+
+class TestSim:
+	def test_deterministic(self):
+		assert sim.play_game(7) == sim.play_game(7)
+		assert sim.play_game(7, max_pieces=5)[0] == 5
+
+	def test_run(self):
+		stats = sim.run(4, processes=1)
+		assert stats["games"] == 4
+		assert stats["placements"] == sum(sim.play_game(i)[0] for i in range(4))
+
+class TestTranspositionCache:
+	def test_lru(self):
+		c = TranspositionCache(max_entries=2)
+		c.put(1, "a")
+		c.put(2, "b")
+		assert c.get(1) == "a"
+		c.put(3, "c")
+		assert 2 not in c and 1 in c and 3 in c
+		assert c.get(2) is None
+		assert c.stats() == {"entries" : 2, "hits" : 1, "misses" : 1,
+		                     "evictions" : 1, "hit_rate" : 0.5}
+
+class TestBeamSearch:
+	def setUp(self):
+		self.b = Board(6, 6, seed=1)
+		for x in range(1, 6):
+			self.b.set_tile_color(x, 5, Color.BLUE)
+		self.b.set_tile_color(5, 4, Color.BLUE)
+
+	def test_features(self):
+		assert search.features(self.b) == (6, 0, 2)
+		self.b.set_tile_color(2, 3, Color.BLUE)
+		assert search.features(self.b) == (8, 1, 6)
+
+	def test_best_move(self):
+		self.b.generate_piece(Piece.I_SHAPE)
+		move = search.BeamSearch(depth=1).best_move(self.b)
+		# Standing the I up in the gap clears the bottom row
+		assert move == (0, 1) or move == (0, 3)
+		ops = search.moves_to(self.b, *move)
+		for op in ops:
+			replay.apply(self.b, op)
+		self.b.full_drop_piece()
+		assert self.b.lines == 1
+
+	def test_pool_deadline(self):
+		b = Board(10, 20, seed=2)
+		b.generate_piece()
+		pooled = search.BeamSearch(depth=3, processes=2)
+		try:
+			assert pooled.best_move(b) == search.BeamSearch(depth=3).best_move(b)
+			# Out of time after the first ply: the move still comes back, and
+			# whatever was left running is kept track of until it finishes
+			assert pooled.best_move(b, 0.0) is not None
+			while pooled._collect_abandoned():
+				pass
+			assert pooled.best_move(b) == search.BeamSearch(depth=3).best_move(b)
+		finally:
+			pooled.close()
+
+class TestServer:
+	def test_wheel(self):
+		wheel = server.TimerWheel(resolution=0.001, slots=64)
+		fired = []
+		async def run():
+			task = asyncio.ensure_future(wheel.run())
+			wheel.schedule(0.005, lambda: fired.append(5))
+			wheel.schedule(0.002, lambda: fired.append(2))
+			await asyncio.sleep(0.05)
+			task.cancel()
+		asyncio.run(run())
+		assert fired == [2, 5]
+
+	def test_session(self):
+		async def run():
+			game = server.GameServer(seed=1, resolution=0.001)
+			listener = await game.start("127.0.0.1", 0)
+			port = listener.sockets[0].getsockname()[1]
+			reader, writer = await asyncio.open_connection("127.0.0.1", port)
+			first = (await reader.readline()).split()
+			writer.write(b"drop\nstats\n")
+			lines = [(await reader.readline()).split() for i in range(2)]
+			writer.close()
+			listener.close()
+			game.wheel_task.cancel()
+			return first, lines
+		first, (dropped, stats) = asyncio.run(run())
+		assert first[0] == b"state" and first[1:4] == [b"0", b"0", b"1"]
+		assert len(first[5].split(b",")) == 20
+		assert dropped[0] == b"state" and dropped[5] != first[5]
+		assert stats[0] == b"stats" and stats[1] == b"1"
+
+	def test_bad_input(self):
+		async def run():
+			game = server.GameServer(seed=1, resolution=0.001)
+			listener = await game.start("127.0.0.1", 0)
+			port = listener.sockets[0].getsockname()[1]
+			reader, writer = await asyncio.open_connection("127.0.0.1", port)
+			writer.write(b"\xff\xfe\n")
+			writer.write(b"x" * (server.MAX_LINE + 1))
+			lines = []
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				if line.startswith(b"error"):
+					lines.append(line)
+			writer.close()
+			listener.close()
+			game.wheel_task.cancel()
+			return lines
+		assert asyncio.run(run()) == [b"error unknown command\n", b"error line too long\n"]
+
+class TestStats:
+	def test_record_summarize(self):
+		path = os.path.join(tempfile.mkdtemp(), "games.tstats")
+		agg = stats.record(path, 20, processes=1, chunk_rows=64)
+		assert agg.games == 20
+		assert agg.placements == sum(sim.play_game(i)[0] for i in range(20))
+		assert sum(agg.shapes) == sum(agg.clears) == agg.placements
+		chunks = list(stats.read_chunks(path))
+		assert len(chunks) > 2
+		placements = sum(len(c["shape"]) for t, c in chunks if t == stats.PLACEMENTS)
+		assert placements == agg.placements
+		assert stats.summarize(path).summary() == agg.summary()
+
+class TestTuner:
+	def test_resume(self):
+		path = os.path.join(tempfile.mkdtemp(), "tune.json")
+		tuner = tune.Tuner(population=3, games=2, max_pieces=5, processes=1,
+		                   checkpoint=path)
+		entries = list(tuner.run(1))
+		assert len(entries) == 1 and entries[0]["best_lines"] >= 0
+		resumed = tune.Tuner(checkpoint=path)
+		assert resumed.generation == 1
+		assert resumed.mean == tuner.mean
+		assert resumed.best == tuner.best
+
+class TestFrameTimer:
+	def test_percentiles(self):
+		t = FrameTimer(window=100)
+		for i in range(200):
+			t.add("render", 0, (i % 100 + 1) / 1000)
+		assert t.percentiles("render") == (0.051, 0.095, 0.099)
+		assert t.percentiles("missing") == (0.0, 0.0, 0.0)
+
+	def test_summary_columns(self):
+		t = FrameTimer()
+		t.add("wait", 0, 0.99462)
+		assert t.summary()[1].split() == ["wait", "994.62", "994.62", "994.62"]
+
+	def test_trace_events(self):
+		t = FrameTimer()
+		t.begin_frame()
+		with t.phase("update"):
+			pass
+		t.end_frame()
+		events = t.trace_events()
+		assert [e["name"] for e in events] == ["update", "frame"]
+		assert all(e["ph"] == "X" and e["dur"] >= 0 for e in events)
+
+class TestReplay:
+	def setUp(self):
+		self.b = Board(10, 20, seed=3)
+		self.b.generate_piece()
+		self.rec = replay.ReplayRecorder(self.b, keyframe_every=8)
+		self.states = []
+		ops = [replay.LEFT, replay.ROTATE_CW, replay.DROP, replay.RIGHT,
+		       replay.DOWN, replay.ROTATE_CCW, replay.FULL_DROP]
+		for i in range(60):
+			self.states.append(replay.encode_board(self.b))
+			self.rec.apply(ops[i % len(ops)], i * 150)
+
+	def test_varint(self):
+		buf = bytearray()
+		for n in (0, 127, 128, 300, 2 ** 40):
+			replay.write_varint(buf, n)
+		pos = 0
+		for n in (0, 127, 128, 300, 2 ** 40):
+			value, pos = replay.read_varint(buf, pos)
+			assert value == n
+		assert pos == len(buf)
+
+	def test_play(self):
+		p = replay.ReplayPlayer(self.rec.getvalue())
+		assert len(p) == 60
+		assert p.ticks[-1] == 59 * 150
+		assert len(p.keyframes) == 7
+		b = p.play()
+		assert replay.encode_board(b) == replay.encode_board(self.b)
+		assert b.score == self.b.score
+
+	def test_version(self):
+		data = bytearray(self.rec.getvalue())
+		data[4] = 1
+		try:
+			replay.ReplayPlayer(bytes(data))
+		except ValueError:
+			pass
+		else:
+			assert False, "read a version 1 replay"
+
+	def test_seek(self):
+		p = replay.ReplayPlayer(self.rec.getvalue())
+		for i in (0, 7, 8, 9, 33, 59):
+			assert replay.encode_board(p.seek(i)) == self.states[i]
+		assert replay.encode_board(p.seek_tick(150 * 20)) == self.states[21]
+
+class TestStream:
+	def setUp(self):
+		self.b = Board(10, 20, seed=5)
+		self.b.generate_piece()
+		self.caster = stream.Broadcaster(self.b, keyframe_every=16)
+		self.ops = [replay.LEFT, replay.ROTATE_CW, replay.DROP, replay.RIGHT,
+		            replay.DOWN, replay.DROP, replay.FULL_DROP]
+
+	def assert_synced(self, decoder):
+		expected = TextView()
+		self.b.render(expected)
+		actual = TextView()
+		decoder.render(actual)
+		assert actual.get_str() == expected.get_str()
+		assert (decoder.score, decoder.lines, decoder.level) == \
+			(self.b.score, self.b.lines, self.b.level)
+
+	def test_decode(self):
+		decoder = stream.FrameDecoder()
+		self.caster.subscribe(decoder.decode)
+		for i in range(100):
+			replay.apply(self.b, self.ops[i % len(self.ops)])
+			self.caster.publish()
+			self.assert_synced(decoder)
+
+	def test_late_subscriber(self):
+		for i in range(40):
+			replay.apply(self.b, self.ops[i % len(self.ops)])
+			self.caster.publish()
+		decoder = stream.FrameDecoder()
+		self.caster.subscribe(decoder.decode)
+		self.assert_synced(decoder)
+
+	def test_unchanged(self):
+		self.caster.publish()
+		assert self.caster.publish() is None
+
+class GhostView(TextView):
+	"""A TextView that also records the ghost squares."""
+
+	def clear(self):
+		TextView.clear(self)
+		self.ghost = set()
+
+	def render_ghost(self, x, y, color):
+		self.ghost.add((x, y, color))
+
+	def clear_ghost(self):
+		self.ghost = set()
+
+class TestAttachedView:
+	def setUp(self):
+		self.b = Board(10, 20, seed=7)
+		self.b.generate_piece()
+		self.v = TextView()
+		self.b.attach(self.v)
+
+	def assert_current(self):
+		expected = TextView()
+		self.b.render(expected)
+		assert self.v.get_str() == expected.get_str()
+
+	def test_moves(self):
+		ops = [replay.LEFT, replay.ROTATE_CW, replay.DROP, replay.RIGHT,
+		       replay.DOWN, replay.ROTATE_CCW, replay.FULL_DROP]
+		for i in range(200):
+			replay.apply(self.b, ops[i % len(ops)])
+			self.assert_current()
+			if self.b.game_over:
+				break
+
+	def test_clear_rows(self):
+		for y in range(17, 20):
+			for x in range(9):
+				self.b.set_tile_color(x, y, Color.BLUE)
+		self.b.clear_tile(3, 19)
+		self.assert_current()
+		self.b.piece = Piece(9, 16, Piece.I_SHAPE, Color.RED, 1)
+		self.b.full_drop_piece()
+		assert self.b.lines == 2
+		self.assert_current()
+
+	def test_ghost_follows_stack(self):
+		v = GhostView()
+		self.b.attach(v)
+		for y in range(16, 20):
+			for x in range(1, 10):
+				self.b.set_tile_color(x, y, Color.BLUE)
+		self.b.clear_rows([17, 18, 19])
+		expected = GhostView()
+		self.b.render(expected)
+		assert v.ghost == expected.ghost
+		assert v.get_str() == expected.get_str()
+		self.b.set_tile_color(self.b.piece.x, 10, Color.RED)
+		expected = GhostView()
+		self.b.render(expected)
+		assert v.ghost == expected.ghost
+
+	def test_restore(self):
+		state = self.b.snapshot()
+		self.b.full_drop_piece()
+		self.b.restore(state)
+		self.assert_current()
+		before = self.v.get_str()
+		self.b.detach(self.v)
+		self.b.full_drop_piece()
+		assert self.v.get_str() == before
+
 #########################
 # Positions for Testing #
 #########################
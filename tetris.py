@@ -1,31 +1,64 @@
 import sys
-import os
+from random import Random
 
 import pygame
 from pygame.locals import *
 
-from engine import TextView, ViewBase, Board, Piece, Color
+from engine import TextView, AnsiView, ViewBase, Board, Piece, Color, level_speed
+from instrument import FrameTimer
+import replay
+import search
 
 _print_dim = False
 
+class GlyphAtlas:
+    """Pre-rendered glyphs of one font and color, for cheaply composing
+    short strings such as the score."""
+
+    CHARS = "0123456789LEVEL "
+
+    def __init__(self, font, color, chars=CHARS):
+        self.height = font.get_height()
+        self.glyphs = {}
+        for ch in set(chars):
+            self.glyphs[ch] = font.render(ch, True, color)
+
+    def size(self, text):
+        return (sum(self.glyphs[ch].get_width() for ch in text), self.height)
+
+    def render(self, text):
+        surf = pygame.Surface(self.size(text), pygame.SRCALPHA)
+        x = 0
+        blits = []
+        for ch in text:
+            glyph = self.glyphs[ch]
+            blits.append((glyph, (x, 0)))
+            x += glyph.get_width()
+        surf.blits(blits, False)
+        return surf
+
 class PygameView(ViewBase):
     """Renders a board in pygame."""
 
-    COLOR_MAP = {
-        Color.CLEAR : pygame.Color(255, 255, 255),
-        Color.RED : pygame.Color(255, 0, 0),
-        Color.BLUE : pygame.Color(0, 255, 0),
-        Color.GREEN : pygame.Color(0, 0, 255),
-        Color.YELLOW : pygame.Color(255, 255, 0),
-        Color.MAGENTA : pygame.Color(255, 0, 255),
-        Color.CYAN : pygame.Color(0, 255, 255),
-        Color.ORANGE : pygame.Color(255, 140, 0)
-    }
-        
+    # Indexed by Color
+    COLOR_MAP = (
+        pygame.Color(255, 255, 255),    # CLEAR
+        pygame.Color(255, 0, 0),        # RED
+        pygame.Color(0, 255, 0),        # BLUE
+        pygame.Color(0, 0, 255),        # GREEN
+        pygame.Color(255, 255, 0),      # YELLOW
+        pygame.Color(255, 0, 255),      # MAGENTA
+        pygame.Color(0, 255, 255),      # CYAN
+        pygame.Color(255, 140, 0),      # ORANGE
+    )
+    # Cells showing a ghost tile hold GHOST + its color
+    GHOST = len(COLOR_MAP)
+
     BOARD_BORDER_SIZE = 5
     SCORE_PADDING = 5
     BORDER_SIZE = 4
     BORDER_FADE = pygame.Color(50, 50, 50)
+    FONT_COLOR = pygame.Color(200, 0, 0)
 
     def __init__(self, surf, fonts):
         ViewBase.__init__(self)
@@ -36,9 +69,22 @@ class PygameView(ViewBase):
         self.padding = (0, 0)
         self.go_font = fonts["game_over"]
         self.sc_font = fonts["score"]
-        self.font_color = pygame.Color(200, 0, 0)
+        self.font_color = self.FONT_COLOR
+        self.sc_glyphs = fonts.get("score_glyphs") or GlyphAtlas(self.sc_font, self.font_color)
         self.score = None
         self.level = None
+        self.score_surf = None
+        self.level_surf = None
+        self.ghost = []
+        self.sprites = []
+
+        # What is currently on screen, for dirty-rectangle updates
+        self.shown = None
+        self.shown_hud = None
+        self.game_over_shown = False
+        self.dirty = []
+        self.overlay_font = None
+        self.overlay_rect = None
 
         self.end_msg = self.go_font.render("GAME OVER", True, self.font_color)
 
@@ -47,43 +93,113 @@ class PygameView(ViewBase):
         ViewBase.set_size(self, cols, rows)
         self.calc_dimensions()
 
+    def clear(self):
+        ViewBase.clear(self)
+        self.ghost = []
+
+    def render_ghost(self, x, y, color):
+        self.ghost.append((x, y, color))
+
+    def clear_ghost(self):
+        self.ghost = []
+
     def set_score(self, score):
+        if score != self.score:
+            self.score_surf = self.sc_glyphs.render("{:06d}".format(score))
         self.score = score
 
     def set_level(self, level):
         if self.level != level:
-            pygame.event.post(pygame.event.Event(Tetris.LEVEL_UP, level = level))
+            self.level_surf = self.sc_glyphs.render("LEVEL {:02d}".format(level))
         self.level = level
 
     def show(self):
-        self.draw_board()
-        self.show_score()
+        """Draws whatever changed since the last call. The changed areas are
+        collected for take_dirty()."""
+        cells = self.get_cells()
+        if self.shown is None:
+            self.draw_board(cells)
+            self.dirty.append(self.surf.get_rect())
+            self.shown_hud = None
+        else:
+            blits = []
+            for y, (row, shown_row) in enumerate(zip(cells, self.shown)):
+                if row == shown_row:
+                    continue
+                for x, (cell, shown_cell) in enumerate(zip(row, shown_row)):
+                    if cell != shown_cell:
+                        blits.append((self.sprites[cell], self.cell_pos(x, y)))
+            if blits:
+                self.dirty.extend(self.surf.blits(blits))
+        self.shown = cells
+
+        if self.shown_hud != (self.score, self.level):
+            hud_rect = pygame.Rect((self.BOARD_BORDER_SIZE, self.BOARD_BORDER_SIZE),
+                                   self.get_score_size())
+            self.surf.fill(self.COLOR_MAP[Color.CLEAR] - self.BORDER_FADE, hud_rect)
+            self.show_score()
+            self.dirty.append(hud_rect)
+            self.shown_hud = (self.score, self.level)
+
+    def show_overlay(self, lines):
+        """Draws lines of debug text in the bottom left corner."""
+        if self.overlay_font is None:
+            self.overlay_font = pygame.font.SysFont("monospace", 12)
+        self.hide_overlay()
+
+        line_height = self.overlay_font.get_linesize()
+        rect = pygame.Rect(self.BOARD_BORDER_SIZE,
+                           self.view_height - self.BOARD_BORDER_SIZE - line_height * len(lines),
+                           self.board_origin()[0] - self.BOARD_BORDER_SIZE * 2,
+                           line_height * len(lines))
+        self.surf.fill(self.COLOR_MAP[Color.CLEAR] - self.BORDER_FADE, rect)
+        self.surf.blits([(self.overlay_font.render(line, True, self.font_color),
+                          (rect.left, rect.top + i * line_height))
+                         for i, line in enumerate(lines)], False)
+        self.dirty.append(rect)
+        self.overlay_rect = rect
+
+    def hide_overlay(self):
+        if self.overlay_rect is not None:
+            self.surf.fill(self.COLOR_MAP[Color.CLEAR] - self.BORDER_FADE, self.overlay_rect)
+            self.dirty.append(self.overlay_rect)
+            self.overlay_rect = None
+
+    def take_dirty(self):
+        """Returns the screen rects changed since the last call."""
+        dirty = self.dirty
+        self.dirty = []
+        return dirty
 
     def show_score(self):
         score_height = 0
-        if self.score is not None:
-            score_surf = self.sc_font.render("{:06d}".format(self.score), True, self.font_color)
-            self.surf.blit(score_surf, (self.BOARD_BORDER_SIZE, self.BOARD_BORDER_SIZE))
-            score_height = score_surf.get_height()
+        if self.score_surf is not None:
+            self.surf.blit(self.score_surf, (self.BOARD_BORDER_SIZE, self.BOARD_BORDER_SIZE))
+            score_height = self.score_surf.get_height()
 
-        if self.level is not None:
-            level_surf = self.sc_font.render("LEVEL {:02d}".format(self.level), True, self.font_color)
+        if self.level_surf is not None:
             level_pos = (self.BOARD_BORDER_SIZE, 
                          self.BOARD_BORDER_SIZE + score_height + self.SCORE_PADDING)
-            self.surf.blit(level_surf, level_pos)
+            self.surf.blit(self.level_surf, level_pos)
 
     def show_game_over(self):
+        if self.game_over_shown:
+            return
         r = self.end_msg.get_rect()
-        self.surf.blit(self.end_msg, (300 - r.width // 2, 300 - r.height // 2))
+        r.center = (300, 300)
+        self.surf.blit(self.end_msg, r)
+        self.dirty.append(r)
+        self.game_over_shown = True
 
     # Helper methods
 
     def get_score_size(self):
-        (sw, sh) = self.sc_font.size("000000")
-        (lw, lh) = self.sc_font.size("LEVEL 00")
+        (sw, sh) = self.sc_glyphs.size("000000")
+        (lw, lh) = self.sc_glyphs.size("LEVEL 00")
         return (max(sw, lw) + self.BOARD_BORDER_SIZE, sh + lh + self.SCORE_PADDING)
 
     def calc_dimensions(self):
+        old_dimensions = (self.box_size, self.padding)
         horiz_size = (self.view_width - (self.BOARD_BORDER_SIZE * 2)) // self.width
         vert_size = (self.view_height - (self.BOARD_BORDER_SIZE * 2)) // self.height
 
@@ -101,6 +217,11 @@ class PygameView(ViewBase):
                                 - (self.width * vert_size)))
             self.padding = (left_padding, 0)
 
+        if (self.box_size, self.padding) != old_dimensions:
+            self.shown = None
+        if self.box_size != old_dimensions[0] or not self.sprites:
+            self.build_sprites()
+
         global _print_dim
         if not _print_dim:
             print(self.width, self.height)
@@ -111,73 +232,156 @@ class PygameView(ViewBase):
             _print_dim = True
 
 
-    def draw_board(self):
+    def get_cells(self):
+        """Returns a copy of the rows with ghost tiles marked as GHOST +
+        their color."""
+        cells = [bytearray(row) for row in self.rows]
+        for x, y, color in self.ghost_tiles():
+            cells[y][x] = self.GHOST + color
+        return cells
+
+    def board_origin(self):
+        return (self.BOARD_BORDER_SIZE + (self.padding[0] // 2),
+                self.BOARD_BORDER_SIZE + (self.padding[1] // 2))
+
+    def draw_board(self, cells):
         bg_color = self.COLOR_MAP[Color.CLEAR]
         self.surf.fill(bg_color - self.BORDER_FADE)
 
-        X_START = self.BOARD_BORDER_SIZE + (self.padding[1] // 2)
-        Y_START = self.BOARD_BORDER_SIZE + (self.padding[0] // 2)
-
-        x = X_START
-        y = Y_START
-        board_rect = (y, x, self.width * self.box_size, self.height * self.box_size)
+        left, top = self.board_origin()
+        board_rect = (left, top, self.width * self.box_size, self.height * self.box_size)
         pygame.draw.rect(self.surf, bg_color, board_rect)
-        for col in self.rows:
-            for item in col:
-                self.draw_box(x, y, item)
-                y += self.box_size
-            x += self.box_size
-            y = Y_START
-
-    def draw_box(self, x, y, color):
-        if color == Color.CLEAR:
-            return
 
+        sprites = self.sprites
+        box = self.box_size
+        self.surf.blits([(sprites[cell], (left + x * box, top + y * box))
+                         for y, row in enumerate(cells)
+                         for x, cell in enumerate(row)
+                         if cell != Color.CLEAR], False)
+
+    def cell_pos(self, col, row):
+        left, top = self.board_origin()
+        return (left + col * self.box_size, top + row * self.box_size)
+
+    def build_sprites(self):
+        """Pre-renders one box_size tile per cell value: every color, a
+        ghost outline for every color, and the empty background."""
+        size = (self.box_size, self.box_size)
+        sprites = [None] * (self.GHOST * 2)
+        for color, pg_color in enumerate(self.COLOR_MAP):
+            if color == Color.CLEAR:
+                sprite = pygame.Surface(size)
+                sprite.fill(pg_color)
+                sprites[color] = sprite
+                continue
+
+            sprite = pygame.Surface(size)
+            self.draw_box(sprite, color)
+            sprites[color] = sprite
+
+            ghost = pygame.Surface(size)
+            ghost.fill(self.COLOR_MAP[Color.CLEAR])
+            self.draw_ghost(ghost, color)
+            sprites[self.GHOST + color] = ghost
+        self.sprites = sprites
+
+    def ghost_tiles(self):
+        """Ghost tiles that aren't covered by the piece itself."""
+        return [(x, y, color) for x, y, color in self.ghost
+                if 0 <= x < self.width and 0 <= y < self.height
+                and self.rows[y][x] == Color.CLEAR]
+
+    def draw_ghost(self, surf, color):
+        bd_color = self.COLOR_MAP[color] - self.BORDER_FADE
+        outer_rect = (0, 0, self.box_size, self.box_size)
+        pygame.draw.rect(surf, bd_color, outer_rect, self.BORDER_SIZE)
+
+    def draw_box(self, surf, color):
         pg_color = self.COLOR_MAP[color]
         bd_size = self.BORDER_SIZE
         bd_color = pg_color - self.BORDER_FADE
 
-        outer_rect = (y, x, self.box_size, self.box_size)
-        inner_rect = (y + bd_size, x + bd_size, 
+        outer_rect = (0, 0, self.box_size, self.box_size)
+        inner_rect = (bd_size, bd_size,
                       self.box_size - bd_size*2, self.box_size - bd_size*2)
 
-        pygame.draw.rect(self.surf, bd_color, outer_rect)
-        pygame.draw.rect(self.surf, pg_color, inner_rect)
+        pygame.draw.rect(surf, bd_color, outer_rect)
+        pygame.draw.rect(surf, pg_color, inner_rect)
 
 class Tetris:
     DROP_EVENT = USEREVENT + 1
-    LEVEL_UP = USEREVENT + 2
 
-    def __init__(self, view_type):
-        self.board = Board(10, 20)
+    KEY_OPS = {
+        K_LEFT : replay.LEFT,
+        K_RIGHT : replay.RIGHT,
+        K_UP : replay.ROTATE_CW,
+        K_DOWN : replay.DOWN,
+        K_a : replay.ROTATE_CCW,
+        K_s : replay.ROTATE_CW,
+        K_SPACE : replay.FULL_DROP,
+    }
+
+    def __init__(self, view_type, event_driven=True, seed=None, record=None,
+                 ai=None, full_render=False):
+        if seed is None:
+            seed = Random().getrandbits(32)
+        self.board = Board(10, 20, seed=seed)
         self.board.generate_piece()
+        # Inputs are recorded to this path when set, see replay.py
+        self.record_path = record
+        self.recorder = replay.ReplayRecorder(self.board) if record else None
+        # A search.BeamSearch to place the pieces, if the computer is playing
+        self.ai = ai
         self.view_type = view_type
         self.game_over = False
-
-        if view_type == TextView:
-            def cls():
-                os.system('cls')
-            self.show_action = cls
-            self.max_fps = 5
+        # In event-driven mode the loop sleeps until input or gravity and
+        # only renders when the board revision changed
+        self.event_driven = event_driven
+        self.rendered_revision = None
+        # Redraw the whole board every frame rather than keeping the view
+        # attached to it
+        self.full_render = full_render
+        # The level the drop timer is running at
+        self.level = 1
+        self.drop_speed = self.get_level_speed(1)
+
+        self.timer = FrameTimer()
+        self.overlay = False
+
+        if issubclass(view_type, TextView):
+            self.max_fps = 30
         else:
-            self.show_action = None
             self.max_fps = 50
 
+    def input(self, op):
+        if self.recorder:
+            self.recorder.apply(op, pygame.time.get_ticks())
+        else:
+            replay.apply(self.board, op)
+
+    def ai_move(self):
+        """Places the current piece where the AI chooses, spending at most
+        half a drop interval deciding."""
+        move = self.ai.best_move(self.board, self.drop_speed / 2000)
+        if move is not None:
+            for op in search.moves_to(self.board, *move):
+                self.input(op)
+        self.input(replay.FULL_DROP)
+
+    def save_replay(self):
+        if self.recorder:
+            self.recorder.save(self.record_path)
+            print("wrote", self.record_path)
+
     def key_handler(self, key):
-        if key == K_LEFT:
-            self.board.move_piece(-1,0)
-        elif key == K_RIGHT:
-            self.board.move_piece(1, 0)
-        elif key == K_UP:
-            self.board.rotate_piece()
-        elif key == K_DOWN:
-            self.board.move_piece(0, 1)
-        elif key == K_a:
-            self.board.rotate_piece(clockwise=False)
-        elif key == K_s:
-            self.board.rotate_piece()
-        elif key == K_SPACE:
-            self.board.full_drop_piece()
+        if key in self.KEY_OPS:
+            self.input(self.KEY_OPS[key])
+        elif key == K_F3:
+            self.overlay = not self.overlay
+            self.rendered_revision = None
+        elif key == K_F4:
+            self.timer.dump_trace("frame_trace.json")
+            print("wrote frame_trace.json")
 
     def init(self):
         pygame.init()
@@ -189,8 +393,15 @@ class Tetris:
             self.fonts = {}
             self.fonts["game_over"] = pygame.font.SysFont("ni7seg", 60)
             self.fonts["score"] = pygame.font.SysFont("ni7seg", 18)
+            self.fonts["score_glyphs"] = GlyphAtlas(self.fonts["score"],
+                                                    PygameView.FONT_COLOR)
 
-        self.view = self.view_type(self.surf, self.fonts)
+        if issubclass(self.view_type, TextView):
+            self.view = self.view_type()
+        else:
+            self.view = self.view_type(self.surf, self.fonts)
+        if not self.full_render:
+            self.board.attach(self.view)
 
     def show_colors(self):
         self.init()
@@ -209,66 +420,115 @@ class Tetris:
                     sys.exit()
 
     def get_level_speed(self, level):
-        SPEEDS = {
-            1 : 1000,
-            2 : 750,
-            3 : 500,
-            4 : 400,
-            5 : 300,
-            6 : 250,
-            7 : 200,
-            8 : 150,
-            9 : 125,
-            10 : 100,
-            11 : 90,
-            12 : 80,
-            13 : 75
-        }
-
-        if level > 13:
-            return 75 - (5 * (level - 13))
-        else:
-            return SPEEDS[level]
+        # level_speed() reaches 0 at level 28, and a timer or wait of 0
+        # never fires
+        return max(level_speed(level), 5)
 
     def render_frame(self):
-        self.board.render(self.view)
+        timer = self.timer
+        self.rendered_revision = self.board.revision
+        if self.full_render:
+            with timer.phase("render"):
+                self.board.render(self.view)
+        with timer.phase("show"):
+            self.view.show()
+
+            if self.game_over:
+                self.view.show_game_over()
+
+        if isinstance(self.view, PygameView):
+            if self.overlay:
+                self.view.show_overlay(timer.summary())
+            else:
+                self.view.hide_overlay()
+
+        with timer.phase("present"):
+            if isinstance(self.view, PygameView):
+                pygame.display.update(self.view.take_dirty())
+            else:
+                pygame.display.update()
+
+    def handle_event(self, event):
+        if event.type == QUIT:
+            self.save_replay()
+            self.view.close()
+            pygame.quit()
+            sys.exit()
+        elif event.type == KEYDOWN:
+            self.key_handler(event.key)
+        elif event.type == self.DROP_EVENT:
+            self.input(replay.DROP)
+
+    def update_level(self):
+        """Speeds up gravity when the board reaches a new level."""
+        if self.board.level == self.level or self.board.game_over:
+            return
+        self.level = self.board.level
+        self.drop_speed = self.get_level_speed(self.level)
+        pygame.time.set_timer(self.DROP_EVENT, self.drop_speed)
+        print("new level:", self.level)
+
+    def get_events(self):
+        if not self.event_driven:
+            return pygame.event.get()
+        # Block until something happens; a drop is never further away than
+        # one drop interval, so that bounds the wait
+        event = pygame.event.wait(self.drop_speed)
+        return [event] + pygame.event.get()
+
+    def run_frame(self):
+        timer = self.timer
+        # Waiting for events isn't part of the frame; in event-driven mode
+        # this is mostly idle time
+        with timer.phase("wait"):
+            events = self.get_events()
+
+        timer.begin_frame()
+        with timer.phase("update"):
+            for event in events:
+                self.handle_event(event)
+            self.update_level()
 
-        if self.show_action is not None:
-            self.show_action()
-        self.view.show()
+            if self.board.game_over and not self.game_over:
+                self.game_over = True
+                self.rendered_revision = None
+                pygame.time.set_timer(self.DROP_EVENT, 0)
+                self.save_replay()
 
-        if self.game_over:
-            self.view.show_game_over()
+        if self.ai and self.board.piece is not None:
+            with timer.phase("ai"):
+                self.ai_move()
+            self.update_level()
 
-        pygame.display.update()
+        if not self.event_driven or self.board.revision != self.rendered_revision:
+            self.render_frame()
+        timer.end_frame()
+        if not self.event_driven:
+            self.clock.tick(self.max_fps)
 
     def main(self):
         self.init()
         self.clock = pygame.time.Clock()
-        pygame.time.set_timer(self.DROP_EVENT, self.get_level_speed(1))
+        pygame.time.set_timer(self.DROP_EVENT, self.drop_speed)
 
-        while True:
-            for event in pygame.event.get():
-                if event.type == QUIT:
-                    pygame.quit()
-                    sys.exit()
-                elif event.type == KEYDOWN:
-                    self.key_handler(event.key)
-                elif event.type == self.DROP_EVENT:
-                    self.board.drop_piece()
-                elif event.type == self.LEVEL_UP:
-                    pygame.time.set_timer(self.DROP_EVENT, self.get_level_speed(event.level))
-                    print("new level:", event.level)
-
-            if self.board.game_over and not self.game_over:
-                self.game_over = True
-                pygame.time.set_timer(self.DROP_EVENT, 0)
-
-            self.render_frame()
-            self.clock.tick(self.max_fps)
+        try:
+            while True:
+                self.run_frame()
+        finally:
+            # Also on Ctrl-C, so a terminal view gets its cursor back
+            self.view.close()
 
 
 if __name__ == "__main__":
-    t = Tetris(PygameView)
+    record = None
+    if "--record" in sys.argv:
+        record = sys.argv[sys.argv.index("--record") + 1]
+    ai = None
+    if "--ai" in sys.argv:
+        from multiprocessing import cpu_count
+        ai = search.BeamSearch(processes=cpu_count())
+    t = Tetris(AnsiView if "--text" in sys.argv else PygameView,
+               event_driven="--poll" not in sys.argv, record=record, ai=ai,
+               full_render="--full-render" in sys.argv)
     t.main()
     #t.show_colors()
\ No newline at end of file
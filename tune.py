@@ -0,0 +1,176 @@
+"""Evaluation weight tuner.
+
+Searches BeamSearch weights with the cross-entropy method: each
+generation samples a population of weight vectors around a mean, plays
+seeded games with each on all cores, and moves the mean towards the
+best. Run with `python -m tune --checkpoint tune.json`; rerunning with
+the same checkpoint resumes where it stopped.
+"""
+import argparse
+import json
+import math
+import os
+import time
+from multiprocessing import Array, Pool, cpu_count
+from random import Random
+
+import search
+import sim
+
+FEATURES = ("height", "lines", "holes", "bumpiness")
+
+
+# Lines cleared per (candidate, game), written by the workers
+_results = None
+
+def _init_worker(results):
+	global _results
+	_results = results
+
+def _play(task):
+	"""Plays one game with one candidate's weights, storing its lines in
+	the shared results array. Only these few numbers cross processes."""
+	slot, weights, seed, width, height, max_pieces = task
+	player = search.BeamSearch(beam_width=1, depth=1,
+	                           weights=dict(zip(FEATURES, weights)))
+	def policy(board, rand):
+		player.position(board)
+	placements, lines, score = sim.play_game(seed, policy, width, height, max_pieces)
+	_results[slot] = lines
+
+
+def _normalize(weights):
+	norm = math.sqrt(sum(w * w for w in weights)) or 1.0
+	return [w / norm for w in weights]
+
+
+class Tuner:
+	"""Cross-entropy search over evaluation weights."""
+
+	def __init__(self, population=20, games=10, elite=0.2, width=10,
+	             height=20, max_pieces=200, seed=0, processes=None,
+	             checkpoint=None):
+		self.population = population
+		self.games = games
+		self.n_elite = max(1, int(population * elite))
+		self.width = width
+		self.height = height
+		self.max_pieces = max_pieces
+		self.seed = seed
+		self.processes = processes or cpu_count()
+		self.checkpoint = checkpoint
+
+		self.generation = 0
+		self.mean = _normalize([search.WEIGHTS[f] for f in FEATURES])
+		self.std = [0.5] * len(FEATURES)
+		self.best = None
+		self.history = []
+		if checkpoint and os.path.exists(checkpoint):
+			self.load(checkpoint)
+
+	def load(self, path):
+		with open(path) as f:
+			state = json.load(f)
+		self.generation = state["generation"]
+		self.mean = state["mean"]
+		self.std = state["std"]
+		self.best = state["best"]
+		self.history = state["history"]
+
+	def save(self, path):
+		"""Writes the tuner's state, replacing the file only once it's
+		complete so a killed run never leaves a broken checkpoint."""
+		state = {"generation" : self.generation,
+		         "mean" : self.mean,
+		         "std" : self.std,
+		         "best" : self.best,
+		         "history" : self.history}
+		with open(path + ".tmp", "w") as f:
+			json.dump(state, f, indent=2)
+		os.replace(path + ".tmp", path)
+
+	def sample(self):
+		"""Returns this generation's candidates. They depend only on the
+		seed and generation number, so a resumed run samples the same."""
+		rand = Random(self.seed * 1000003 + self.generation)
+		return [_normalize([rand.gauss(m, s) for m, s in zip(self.mean, self.std)])
+		        for i in range(self.population)]
+
+	def step(self, pool, results):
+		"""Runs one generation, returning its history entry."""
+		candidates = self.sample()
+		# Every candidate plays the same games
+		seeds = [self.seed * 1000003 + self.generation * self.games + g
+		         for g in range(self.games)]
+		tasks = [(c * self.games + g, weights, seed, self.width, self.height,
+		          self.max_pieces)
+		         for c, weights in enumerate(candidates)
+		         for g, seed in enumerate(seeds)]
+		start = time.perf_counter()
+		chunksize = max(1, len(tasks) // (8 * self.processes))
+		for _ in pool.imap_unordered(_play, tasks, chunksize):
+			pass
+		elapsed = time.perf_counter() - start
+
+		scores = [sum(results[c * self.games:(c + 1) * self.games]) / self.games
+		          for c in range(self.population)]
+		ranked = sorted(range(self.population), key=lambda c: scores[c], reverse=True)
+		elite = [candidates[c] for c in ranked[:self.n_elite]]
+		n = len(elite)
+		self.mean = [sum(w[i] for w in elite) / n for i in range(len(FEATURES))]
+		# A little extra noise keeps the search from collapsing early
+		self.std = [math.sqrt(sum((w[i] - self.mean[i]) ** 2 for w in elite) / n)
+		            + 0.05 / (self.generation + 1) for i in range(len(FEATURES))]
+
+		best = ranked[0]
+		if self.best is None or scores[best] > self.best["lines"]:
+			self.best = {"weights" : dict(zip(FEATURES, candidates[best])),
+			             "lines" : scores[best],
+			             "generation" : self.generation}
+		entry = {"generation" : self.generation,
+		         "best_lines" : scores[best],
+		         "mean_lines" : sum(scores) / len(scores),
+		         "games_per_sec" : len(tasks) / elapsed}
+		self.history.append(entry)
+		self.generation += 1
+		if self.checkpoint:
+			self.save(self.checkpoint)
+		return entry
+
+	def run(self, generations):
+		"""Runs until `generations` generations are done in total."""
+		results = Array("i", self.population * self.games, lock=False)
+		with Pool(self.processes, _init_worker, (results,)) as pool:
+			while self.generation < generations:
+				yield self.step(pool, results)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Tune autoplayer weights by self-play.")
+	parser.add_argument("--generations", type=int, default=10)
+	parser.add_argument("--population", type=int, default=20)
+	parser.add_argument("--games", type=int, default=10,
+	                    help="games per candidate per generation")
+	parser.add_argument("--max-pieces", type=int, default=200)
+	parser.add_argument("--width", type=int, default=10)
+	parser.add_argument("--height", type=int, default=20)
+	parser.add_argument("--processes", type=int, default=None)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--checkpoint", default=None,
+	                    help="JSON file to save each generation to and resume from")
+	args = parser.parse_args(argv)
+
+	tuner = Tuner(args.population, args.games, width=args.width,
+	              height=args.height, max_pieces=args.max_pieces, seed=args.seed,
+	              processes=args.processes, checkpoint=args.checkpoint)
+	if tuner.generation:
+		print("resuming at generation {}".format(tuner.generation))
+	for entry in tuner.run(args.generations):
+		print("generation {generation}: best {best_lines:.1f} lines, "
+		      "mean {mean_lines:.1f}, {games_per_sec:.1f} games/sec".format(**entry))
+	if tuner.best:
+		print("best weights:", json.dumps(tuner.best["weights"]))
+
+
+if __name__ == "__main__":
+	main()